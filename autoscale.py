@@ -1,14 +1,76 @@
-import requests
 import utils
+import json
 import difflib
+import hashlib
+from multiprocessing.pool import ThreadPool
+from load_balancing import timing
 from colors import bcolors
 from colors import print_msg
 
+# Key in the launch configuration's metadata holding its fingerprint
+FINGERPRINT_KEY = 'rax-autoscaler-setup-fingerprint'
+# Launch configuration keys covered by the fingerprint, i.e. everything set
+# by create_group() and update_launch_config()
+FINGERPRINT_KEYS = ('name', 'flavor', 'image', 'disk_config', 'metadata',
+                    'key_name', 'user_data', 'config_drive', 'networks')
+
+
+def get_fingerprint(lc_config):
+    """ Returns a hash of the launch configuration in the config file, which
+        stays the same for as long as the configuration does
+    """
+    launch_config = dict((key, getattr(lc_config, key))
+                         for key in FINGERPRINT_KEYS)
+    launch_config['metadata'] = dict(
+        (k, v) for k, v in (launch_config['metadata'] or {}).iteritems()
+        if k != FINGERPRINT_KEY)
+    canonical = json.dumps(launch_config, sort_keys=True,
+                           separators=(',', ':'))
+    return hashlib.sha256(canonical).hexdigest()
+
+
+class GroupSnapshot(object):
+    """ Remote state of a scaling group: the group itself, its launch
+        configuration and its policies keyed by name. The three are
+        independent API calls and are fetched concurrently.
+    """
+
+    @timing.timed('autoscale.fetch_snapshot')
+    def __init__(self, autoscale_client, group_id):
+        pool = ThreadPool(3)
+        try:
+            group = pool.apply_async(autoscale_client.get, (group_id,))
+            launch_config = pool.apply_async(
+                autoscale_client.get_launch_config, (group_id,))
+            policies = pool.apply_async(autoscale_client.list_policies,
+                                        (group_id,))
+            # Fetch the group first, so a non-existent group raises NotFound
+            # from the group lookup rather than from the others
+            self.scaling_group = group.get()
+            self.launch_config = launch_config.get()
+            self.policies = dict((policy.name, policy)
+                                 for policy in policies.get())
+        finally:
+            pool.close()
+            pool.join()
+
 
 class autoscale:
 
-    def __init__(self, config, pyrax):
+    @timing.timed('autoscale.init')
+    def __init__(self, config, pyrax, sync=True, msg_func=print_msg,
+                 detailed_diff=False):
+        """ Loads (or creates) the scaling group described by config and
+            compares it to the config file. Unless sync is False, the user
+            is prompted to apply any differences found.
+            msg_func is called as msg_func(msg, colour) for all output.
+            The launch configuration is compared by fingerprint only, unless
+            detailed_diff is set, in which case the keys that differ are
+            shown too.
+        """
         self.pyrax = pyrax
+        self.msg = msg_func
+        self.detailed_diff = detailed_diff
         self.config = config
         self.as_config = config.get_autoscale_config()
         # Launch config as read from the config file
@@ -20,23 +82,28 @@ class autoscale:
         self.scale_down_policy = None
         # Launch config set on the scaling group
         self.launch_config = None
+        # Policies on the scaling group keyed by name, populated on first
+        # lookup and dropped by invalidate_policies() whenever they change
+        self._policies = None
+        # Result of diff_group() against an existing group
+        self.diffs = None
 
         self.group_id = self.as_config.id
         if not self.group_id:
             self.create_group()
             self.launch_config = self.scaling_group.get_launch_config()
-            print_msg("Created - %s - %s " %
-                      (self.scaling_group.name, self.scaling_group.id),
-                      bcolors.OKGREEN)
+            self.msg("Created - %s - %s " %
+                     (self.scaling_group.name, self.scaling_group.id),
+                     bcolors.OKGREEN)
 
         else:
-            self.scaling_group = self.autoscale.get(self.group_id)
-            self.launch_config = self.scaling_group.get_launch_config()
-            diffs = self.diff_group()
-            if self.check_and_confirm_change(diffs):
-                self.update_group(diffs.get('scaling_group', None))
-                self.update_launch_config(diffs.get('launch_config', None))
-                self.update_policies(diffs)
+            snapshot = GroupSnapshot(self.autoscale, self.group_id)
+            self.scaling_group = snapshot.scaling_group
+            self.launch_config = snapshot.launch_config
+            self._policies = snapshot.policies
+            self.diffs = self.diff_group()
+            if sync and self.check_and_confirm_change(self.diffs):
+                self.apply_diffs(self.diffs)
 
     def check_and_confirm_change(self, diffs):
         """ Checks whether there are any changes detected between
@@ -49,6 +116,15 @@ class autoscale:
                              " config to match the config file? (y/n): ",
                              yesno=True)
 
+    @timing.timed('autoscale.apply_diffs')
+    def apply_diffs(self, diffs):
+        """ Updates the running config to match the config file for
+            every part diff_group() found to differ
+        """
+        self.update_group(diffs.get('scaling_group', None))
+        self.update_launch_config(diffs.get('launch_config', None))
+        self.update_policies(diffs)
+
     def update_group(self, diffs):
         if not diffs:
             return
@@ -57,9 +133,9 @@ class autoscale:
                                       cooldown=self.as_config.cooldown,
                                       min_entities=self.as_config.min_entities,
                                       max_entities=self.as_config.max_entities)
-            print_msg("Group successfully updated", bcolors.OKGREEN)
+            self.msg("Group successfully updated", bcolors.OKGREEN)
         except Exception as ex:
-            print_msg("Failed to update group - %s" % ex, bcolors.FAIL)
+            self.msg("Failed to update group - %s" % ex, bcolors.FAIL)
 
     def update_policies(self, diffs):
         if diffs.get('scale_up_policy'):
@@ -68,6 +144,7 @@ class autoscale:
         if diffs.get('scale_down_policy'):
             self.update_policy(self.get_scale_down_policy(),
                                self.as_config.scale_down)
+        self.invalidate_policies()
 
     def update_launch_config(self, diffs):
         if not diffs:
@@ -76,7 +153,7 @@ class autoscale:
                                                 server_name=self.lc_config.name,
                                                 flavor=self.lc_config.flavor,
                                                 disk_config=self.lc_config.disk_config,
-                                                metadata=self.lc_config.metadata,
+                                                metadata=self.get_metadata(),
                                                 key_name=self.lc_config.key_name,
                                                 user_data=self.lc_config.user_data,
                                                 config_drive=self.lc_config.config_drive,
@@ -86,15 +163,24 @@ class autoscale:
         policy.update(cooldown=self.as_config.cooldown,
                       change=change)
 
+    def get_metadata(self):
+        """ Returns the metadata for the launch configuration, including the
+            fingerprint of the configuration it is part of
+        """
+        metadata = dict(self.lc_config.metadata or {})
+        metadata[FINGERPRINT_KEY] = get_fingerprint(self.lc_config)
+        return metadata
+
     def get_user_data_from_file(self):
         file_name = self.lc_config.cloud_init
         if not file_name:
             return None
         if not utils.is_readable(file_name):
-            print_msg("Can't open cloud-init file %s for reading" %
-                      file_name, bcolors.FAIL)
+            self.msg("Can't open cloud-init file %s for reading" %
+                     file_name, bcolors.FAIL)
         return open(file_name, 'r').read()
 
+    @timing.timed('autoscale.create_group')
     def create_group(self):
         self.scaling_group = self.autoscale.create(self.as_config.name,
                                                    cooldown=self.as_config.cooldown,
@@ -105,7 +191,7 @@ class autoscale:
                                                    flavor=self.lc_config.flavor,
                                                    image=self.lc_config.image,
                                                    disk_config=self.lc_config.disk_config,
-                                                   metadata=self.lc_config.metadata,
+                                                   metadata=self.get_metadata(),
                                                    key_name=self.lc_config.key_name,
                                                    user_data=self.lc_config.user_data,
                                                    config_drive=self.lc_config.config_drive,
@@ -119,21 +205,32 @@ class autoscale:
                                                     self.as_config.scale_down)
         up_policy.add_webhook('scale_up_webhook')
         down_policy.add_webhook('scale_down_webhook')
+        self.invalidate_policies()
+
+    def invalidate_policies(self):
+        """ Drops the cached policy index, so the next lookup lists the
+            policies on the scaling group again
+        """
+        self._policies = None
 
     def get_policies(self):
-        return self.scaling_group.list_policies()
+        """ Returns a dict of the policies on the scaling group keyed by
+            name. The API is only queried once per run, unless
+            invalidate_policies() has been called since
+        """
+        if self._policies is None:
+            self._policies = dict((policy.name, policy) for policy in
+                                  self.scaling_group.list_policies())
+        return self._policies
+
+    def get_policy(self, name):
+        return self.get_policies().get(name)
 
     def get_scale_up_policy(self):
-        for policy in self.get_policies():
-            if policy.name == 'scale_up':
-                return policy
-        return None
+        return self.get_policy('scale_up')
 
     def get_scale_down_policy(self):
-        for policy in self.get_policies():
-            if policy.name == 'scale_down':
-                return policy
-        return None
+        return self.get_policy('scale_down')
 
     def get_id(self):
         """ Returns the ID of the scaling group in this object """
@@ -146,6 +243,7 @@ class autoscale:
         """
         return policy.list_webhooks()[0]
 
+    @timing.timed('autoscale.get_webhook_url')
     def get_webhook_url(self, policy):
         """ Returns string containing webhook URL for a given policy """
         endpoint = self.autoscale.management_url
@@ -160,7 +258,8 @@ class autoscale:
               policy_id,
               webhook_id)
 
-        result = requests.get(url, headers=headers)
+        result = utils.get_http_session().get(url, headers=headers,
+                                              timeout=utils.HTTP_TIMEOUT)
         if result.status_code != 200:
             raise Exception("Unable to get webhook URLs API returned: "
                             "%s - %s" % (result.status_code, result.text))
@@ -181,11 +280,11 @@ class autoscale:
         for key in autoscale_keys:
             if getattr(self.scaling_group, key) !=\
                getattr(self.as_config, key):
-                print_msg("Difference detected in key %s: %s != %s" % (key,
-                                                                       getattr(
-                                                                           self.scaling_group, key),
-                                                                       getattr(self.as_config, key)),
-                          bcolors.FAIL)
+                self.msg("Difference detected in key %s: %s != %s" % (key,
+                                                                      getattr(
+                                                                          self.scaling_group, key),
+                                                                      getattr(self.as_config, key)),
+                         bcolors.FAIL)
                 diff_found = True
         return diff_found
 
@@ -193,10 +292,10 @@ class autoscale:
         diff_found = False
         policy = self.get_scale_up_policy()
         if int(policy.change) != int(self.as_config.scale_up):
-            print_msg("Difference detected in key scale_up: %s != %s" % (
-                      policy.change,
-                      self.as_config.scale_up),
-                      bcolors.FAIL)
+            self.msg("Difference detected in key scale_up: %s != %s" % (
+                     policy.change,
+                     self.as_config.scale_up),
+                     bcolors.FAIL)
             diff_found = True
         return diff_found
 
@@ -204,58 +303,96 @@ class autoscale:
         diff_found = False
         policy = self.get_scale_down_policy()
         if int(policy.change) != int(self.as_config.scale_down):
-            print_msg("Difference detected in key scale_down: %s != %s" % (
-                      policy.change,
-                      self.as_config.scale_down),
-                      bcolors.FAIL)
+            self.msg("Difference detected in key scale_down: %s != %s" % (
+                     policy.change,
+                     self.as_config.scale_down),
+                     bcolors.FAIL)
             diff_found = True
         return diff_found
 
     def diff_launch_config(self):
+        """ Compares the fingerprint stored with the launch configuration to
+            that of the config file. The launch configuration is only compared
+            key by key when they differ and a detailed diff was asked for, or
+            when it has no fingerprint (i.e. was set up before they were used),
+            in which case it always needs updating to store one
+        """
+        remote = (self.launch_config.get('metadata') or {}).get(
+            FINGERPRINT_KEY)
+        if remote is None:
+            # Updating it stores the fingerprint, so that later runs don't
+            # need to compare it key by key again
+            if not self.diff_launch_config_keys():
+                self.msg("Launch configuration has no fingerprint yet,"
+                         " update it to store one", bcolors.WARNING)
+            return True
+        if remote == get_fingerprint(self.lc_config):
+            return False
+        if self.detailed_diff:
+            self.diff_launch_config_keys()
+        else:
+            self.msg("Difference detected in section 'launch-configuration'"
+                     " (run with --detailed-diff to show it)", bcolors.FAIL)
+        return True
+
+    def diff_launch_config_keys(self):
         diff_found = False
         for key in self.launch_config:
             if key == 'name':
                 if str(self.launch_config.get(key)) != \
                    str(getattr(self.lc_config, key)):
-                    print_msg("Difference detected in key name in section"
-                              " 'launch-configuration': %s != %s" % (
-                                  self.launch_config.get(key),
-                                  getattr(self.lc_config, key)),
-                              bcolors.FAIL)
+                    self.msg("Difference detected in key name in section"
+                             " 'launch-configuration': %s != %s" % (
+                                 self.launch_config.get(key),
+                                 getattr(self.lc_config, key)),
+                             bcolors.FAIL)
                     diff_found = True
             elif key == 'load_balancers':
                 # We don't let Autoscale manage load balancers for us
                 pass
             elif key == 'user_data':
-                if getattr(self.lc_config, (key)) \
-                        != utils.unb64(self.launch_config.get(key)):
-                    print_msg("Difference detected in key user_data in section"
-                              " launch-configuration' (new config at the"
-                              " bottom):", bcolors.FAIL)
+                user_data = utils.unb64(self.launch_config.get(key))
+                if getattr(self.lc_config, (key)) != user_data:
+                    self.msg("Difference detected in key user_data in section"
+                             " launch-configuration' (new config at the"
+                             " bottom):", bcolors.FAIL)
                     ud_diffs = difflib.context_diff(
-                        utils.unb64(self.launch_config.get(key)).splitlines(),
+                        user_data.splitlines(),
                         getattr(self.lc_config, (key)).splitlines())
                     for a in ud_diffs:
-                        print a
+                        self.msg(a, bcolors.ENDC)
+
+                    diff_found = True
 
+            elif key == 'metadata':
+                metadata = dict(self.launch_config.get(key) or {})
+                metadata.pop(FINGERPRINT_KEY, None)
+                if metadata != getattr(self.lc_config, key):
+                    self.msg("Difference detected in key metadata in section"
+                             " 'launch-configuration': %s != %s" % (
+                                 metadata, getattr(self.lc_config, key)),
+                             bcolors.FAIL)
                     diff_found = True
 
             else:
                 if self.launch_config.get(key) != getattr(self.lc_config, key):
-                    print_msg("Difference detected in key %s in section"
-                              " 'launch-configuration': %s != %s" % (
-                                  key,
-                                  self.launch_config.get(key),
-                                  getattr(self.lc_config, key)),
-                              bcolors.FAIL)
+                    self.msg("Difference detected in key %s in section"
+                             " 'launch-configuration': %s != %s" % (
+                                 key,
+                                 self.launch_config.get(key),
+                                 getattr(self.lc_config, key)),
+                             bcolors.FAIL)
                     diff_found = True
         return diff_found
 
+    @timing.timed('autoscale.diff_group')
     def diff_group(self):
         """ Compares an existing group with the config variables.
             Returns a tuple of dicts containing the parameters that
             are different in the scaling group and launch configuration
-            from what's defined in the config file or None if they match
+            from what's defined in the config file or None if they match.
+            Works purely on the state already fetched into this object
+            (see GroupSnapshot), so no API calls are made.
         """
 
         diffs = {}
@@ -267,6 +404,6 @@ class autoscale:
         if any(k[1] for k in diffs.iteritems()):
             return diffs
 
-        print_msg("Running scaling group config matches"
-                  " that of config file...", bcolors.OKGREEN)
+        self.msg("Running scaling group config matches"
+                 " that of config file...", bcolors.OKGREEN)
         return None
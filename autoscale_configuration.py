@@ -7,6 +7,16 @@ class AutoscaleConfig(object):
         configuration.
     """
 
+    section = 'autoscale'
+    # Type of each key, and whether it is required
+    schema = {'name': (basestring, True),
+              'id': (basestring, False),
+              'scale_up': (int, True),
+              'scale_down': (int, True),
+              'max_entities': (int, True),
+              'min_entities': (int, True),
+              'cooldown': (int, True)}
+
     def __init__(self):
         pass
     name = None
@@ -18,26 +28,7 @@ class AutoscaleConfig(object):
     cooldown = None
 
     def validate(self):
-        """ Iterates over class attributes and verifies that they have been set
-        during the config parsing or config writing process
+        """ Verifies that the attributes have been set to values of the
+        right type during the config parsing or config writing process
         """
-        ok_missing = ['id']
-        expected_ints = ['scale_up', 'scale_down', 'max_entities',
-                         'min_entities', 'cooldown']
-        for obj in [obj for obj in dir(self)
-                    if not obj.startswith('__') and obj not in ok_missing]:
-            if getattr(self, obj) is None:
-                raise AttributeError(
-                    "Config file parsing failed - key %s missing or has no"
-                    " value in section 'autoscale' Try re-running"
-                    " with --create-config" % obj)
-            if not isinstance(getattr(self, obj), int) \
-               and obj in expected_ints:
-                raise AttributeError(utils.get_parse_error(obj, 'autoscale',
-                                                           'int'))
-        if not isinstance(self.name, str):
-            raise AttributeError(utils.get_parse_error('name', 'autoscale',
-                                                       'str'))
-
-        return True
-
+        return utils.check_section(self)
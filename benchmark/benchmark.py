@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+
+###################################################################################
+#                                                                                 #
+# Runs the entry points of this repository against fake_api.py for groups of      #
+# increasing size, and reports the number of API calls each one made and how     #
+# long it took:                                                                   #
+#                                                                                 #
+#  - remove_dead_nodes: one run of load_balancing/remove_dead_nodes.py, with a    #
+#    tenth of the load balancer's nodes belonging to servers no longer in the     #
+#    group, and as many servers outside the group as in it                        #
+#  - add_self_to_lb: a tenth of the group's size in new servers running           #
+#    load_balancing/add_self_to_lb.py at the same time, as in a large scale up    #
+#  - autoscale: what main.py does for an existing group - fetch and diff it       #
+#    against its config file, and look up the webhook URLs (pyrax only)           #
+#                                                                                 #
+# Each runs with the lightweight client and with pyrax, when pyrax is installed.  #
+# Pass --save to store the results, and --compare to fail (exit code 1) when a    #
+# later run makes more API calls, or takes more than --tolerance longer, than     #
+# the stored results.                                                             #
+#                                                                                 #
+# e.g.                                                                            #
+#   python benchmark/benchmark.py --save baseline.json                            #
+#   python benchmark/benchmark.py --compare baseline.json                         #
+#                                                                                 #
+# License: Apache License Version 2.0 http://www.apache.org/licenses/LICENSE-2.0  #
+###################################################################################
+
+from __future__ import print_function
+
+import os
+import imp
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'load_balancing'))
+
+import fake_api
+from fake_api import FakeCloud, FakeApiServer
+
+SCENARIOS = (10, 100, 1000)
+
+CONFIG_TEMPLATE = """[cloud]
+username = 'benchmark'
+api_key = 'benchmark'
+region = '%(region)s'
+
+[autoscale]
+name = 'autoscale_group'
+id = '%(group_id)s'
+scale_up = 2
+scale_down = -2
+max_entities = %(max_entities)d
+min_entities = 2
+cooldown = 10
+
+[launch-configuration]
+name = 'autoscaled_server'
+flavor = 'performance1-1'
+image = '09de0a66-3156-48b4-90a5-1cf25a905207'
+disk_config = 'MANUAL'
+skip_default_networks = False
+networks = []
+
+[rax-autoscaler]
+load_balancers = []
+private_key = ''
+admin_server = ''
+"""
+
+
+class SkipScenario(Exception):
+    """ Raised by a Benchmark.run_* method that can't run with its client """
+
+
+class Result(object):
+
+    def __init__(self, entry_point, client, nodes):
+        self.entry_point = entry_point
+        self.client = client
+        self.nodes = nodes
+        self.wall_time = None
+        self.calls = None
+        self.errors = None
+        self.skipped = None
+        self.failed = None
+
+    def key(self):
+        return '%s/%s/%d' % (self.entry_point, self.client, self.nodes)
+
+    def to_dict(self):
+        return {'wall_time': self.wall_time, 'calls': self.calls,
+                'errors': self.errors, 'failed': self.failed}
+
+
+class Benchmark(object):
+    """ A fake API with a group of the given size, and an authenticated
+        client for it
+    """
+
+    def __init__(self, nodes, client, args):
+        self.nodes = nodes
+        self.client = client
+        self.cloud = FakeCloud(nodes=nodes, stray_nodes=max(1, nodes // 10),
+                               other_servers=nodes, latency=args.latency,
+                               pending_update=args.pending_update,
+                               error_rate=args.error_rate)
+        self.server = FakeApiServer(self.cloud).start()
+        # The health check is a CONNECT to the load balancer's port, which
+        # the fake API itself answers
+        self.cloud.lb['port'] = self.server.server_address[1]
+        # Fresh token cache, as the catalog of another run points elsewhere
+        self.cache_dir = tempfile.mkdtemp()
+        self.api = self.connect()
+
+    def connect(self, cache_dir=None):
+        import token_cache
+        if self.client == 'light':
+            import light_client
+            light_client.IDENTITY_URL = self.server.identity_url()
+            return light_client.Api(light_client.Client(
+                'benchmark', 'benchmark', fake_api.REGION,
+                cache_dir=cache_dir or self.cache_dir))
+
+        import pyrax
+        pyrax.set_setting('identity_type', 'rackspace')
+        pyrax.set_setting('auth_endpoint', self.server.url + '/v2.0/')
+        pyrax.set_setting('region', fake_api.REGION)
+        token_cache.authenticate(pyrax, username='benchmark',
+                                 api_key='benchmark', region=fake_api.REGION,
+                                 cache_dir=self.cache_dir)
+        return pyrax
+
+    def close(self):
+        # Lets the server's threads for kept-alive connections finish
+        if self.client == 'light':
+            self.api.client.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def run(self, entry_point):
+        result = Result(entry_point, self.client, self.nodes)
+        func = getattr(self, 'run_' + entry_point)
+        self.cloud.reset_stats()
+        started = time.time()
+        try:
+            func()
+        except SkipScenario as ex:
+            result.skipped = str(ex)
+            return result
+        except Exception as ex:
+            # e.g. too many injected errors, still worth reporting on
+            result.failed = str(ex)
+        result.wall_time = time.time() - started
+        stats = self.cloud.stats()
+        result.calls = stats['total']
+        result.errors = stats['errors']
+        return result
+
+    def run_remove_dead_nodes(self):
+        import remove_dead_nodes
+        remove_dead_nodes.lbs = [fake_api.LB_ID]
+        remove_dead_nodes.as_group = fake_api.GROUP_ID
+        remove_dead_nodes.drain_timeout = 0
+        remove_dead_nodes.drain_state_file = os.path.join(self.cache_dir,
+                                                          'drain.json')
+        remove_dead_nodes.status_file = None
+        clb = self.api.cloud_loadbalancers
+        asg = self.api.autoscale.get(fake_api.GROUP_ID)
+        address_cache = remove_dead_nodes.AddressCache(
+            self.api.cloudservers)
+        remove_dead_nodes.reconcile_until_drained(clb, asg, address_cache)
+
+    def run_add_self_to_lb(self):
+        import add_self_to_lb
+        add_self_to_lb.iface = 'lo'
+        add_self_to_lb.coordinator_url = None
+        add_self_to_lb.readiness_url = None
+        new_servers = max(1, self.nodes // 10)
+        addresses = ['10.178.%d.%d' % divmod(i, 250)
+                     for i in range(new_servers)]
+
+        def add_server(address):
+            # Every server authenticates with its own client, except with
+            # pyrax, which is one per process
+            if self.client == 'light':
+                api = self.connect(os.path.join(self.cache_dir, address))
+            else:
+                api = self.api
+            try:
+                return add_self_to_lb.register(api, fake_api.LB_ID, address)
+            finally:
+                if self.client == 'light':
+                    api.client.session.close()
+
+        pool = ThreadPool(new_servers)
+        try:
+            results = pool.map(add_server, addresses)
+        finally:
+            pool.close()
+            pool.join()
+        failed = [r for r in results
+                  if r.status != add_self_to_lb.Registration.ADDED]
+        if failed:
+            raise Exception("%d servers not added, e.g. %s: %s" % (
+                len(failed), failed[0].status, failed[0].message))
+
+    def run_autoscale(self):
+        if self.client != 'pyrax':
+            raise SkipScenario("main.py needs pyrax")
+        import utils
+        import autoscale
+        config_file = os.path.join(self.cache_dir, 'autoscaler.ini')
+        with open(config_file, 'w') as fp:
+            fp.write(CONFIG_TEMPLATE % {
+                'region': fake_api.REGION, 'group_id': fake_api.GROUP_ID,
+                'max_entities': self.cloud.group['groupConfiguration'][
+                    'maxEntities']})
+        config = utils.config(config_file, validate=False)
+        auto_scale = autoscale.autoscale(config, self.api, sync=False,
+                                         msg_func=lambda msg, colour: None)
+        auto_scale.get_webhook_url(auto_scale.get_scale_up_policy())
+        auto_scale.get_webhook_url(auto_scale.get_scale_down_policy())
+
+
+def get_clients(requested):
+    if requested != 'all':
+        return [requested]
+    # Only look for pyrax here, importing it takes a while
+    try:
+        imp.find_module('pyrax')
+        return ['light', 'pyrax']
+    except ImportError:
+        return ['light']
+
+
+def print_result(result):
+    if result.skipped:
+        print("%-18s %-6s %6d  skipped: %s" % (
+            result.entry_point, result.client, result.nodes, result.skipped))
+    else:
+        print("%-18s %-6s %6d %9.3fs %7d %7d%s" % (
+            result.entry_point, result.client, result.nodes,
+            result.wall_time, result.calls, result.errors,
+            "  FAILED: %s" % result.failed if result.failed else ''))
+
+
+def compare(results, baseline, tolerance):
+    """ Returns a list of results that got worse than the baseline """
+    regressions = []
+    for result in results:
+        previous = baseline.get(result.key())
+        if result.skipped or not previous:
+            continue
+        if result.failed and not previous.get('failed'):
+            regressions.append("%s: failed: %s" % (result.key(),
+                                                    result.failed))
+        if result.calls > previous['calls']:
+            regressions.append("%s: %d API calls, was %d" % (
+                result.key(), result.calls, previous['calls']))
+        if result.wall_time > previous['wall_time'] * (1 + tolerance):
+            regressions.append("%s: %.3fs, was %.3fs" % (
+                result.key(), result.wall_time, previous['wall_time']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        'Benchmark the scripts against a fake API')
+    parser.add_argument('--scenarios', type=str,
+                        default=','.join(str(n) for n in SCENARIOS),
+                        help='Comma separated group sizes (default %s)' %
+                             ','.join(str(n) for n in SCENARIOS))
+    parser.add_argument('--entry-points', type=str,
+                        default='remove_dead_nodes,add_self_to_lb,autoscale',
+                        help='Comma separated entry points to run')
+    parser.add_argument('--client', choices=['light', 'pyrax', 'all'],
+                        default='all',
+                        help='API client to run with (default: both, if'
+                             ' pyrax is installed)')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='Seconds every API request takes'
+                             ' (default 0.02)')
+    parser.add_argument('--pending-update', type=float, default=0.2,
+                        help='Seconds a load balancer stays in'
+                             ' PENDING_UPDATE after a change (default 0.2)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Share of API requests (0-1) to fail with a'
+                             ' 503 (default 0)')
+    parser.add_argument('--save', type=str, default=None,
+                        help='Write the results to this file')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='Compare the results to a file written by'
+                             ' --save, and exit with 1 if any got worse')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='How much slower (0.25 = 25%%) a run may be'
+                             ' than with --compare before it counts as a'
+                             ' regression (default 0.25)')
+    args = parser.parse_args()
+
+    # The scripts log every node they remove
+    logging.disable(logging.INFO)
+
+    results = []
+    print("%-18s %-6s %6s %10s %7s %7s" % ('entry point', 'client', 'nodes',
+                                            'wall time', 'calls', 'errors'))
+    for nodes in [int(n) for n in args.scenarios.split(',')]:
+        for client in get_clients(args.client):
+            bench = Benchmark(nodes, client, args)
+            try:
+                for entry_point in args.entry_points.split(','):
+                    result = bench.run(entry_point)
+                    results.append(result)
+                    print_result(result)
+            finally:
+                bench.close()
+
+    if args.save:
+        with open(args.save, 'w') as fp:
+            json.dump(dict((r.key(), r.to_dict()) for r in results
+                           if not r.skipped), fp, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare, 'r') as fp:
+            regressions = compare(results, json.load(fp), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION %s" % regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,510 @@
+#!/usr/bin/env python
+
+###################################################################################
+#                                                                                 #
+# A local stand-in for the parts of the Rackspace Cloud API used by main.py and   #
+# the load balancing scripts: identity, autoscale, cloud servers and cloud load   #
+# balancers. Everything is kept in memory, in one account with one scaling group  #
+# and one load balancer.                                                          #
+#                                                                                 #
+# Like the real API, a load balancer goes into PENDING_UPDATE for a while after   #
+# every change, and rejects further changes until it is ACTIVE again. Requests    #
+# can be slowed down by a fixed latency, and a share of them can be failed with   #
+# a 503 to exercise the retries.                                                  #
+#                                                                                 #
+# Every request is counted by endpoint. GET /_stats returns the counts, and       #
+# POST /_stats resets them.                                                       #
+#                                                                                 #
+# Used by benchmark.py, but it can also be run on its own, e.g.                   #
+#   python benchmark/fake_api.py --nodes 100 --port 8900                          #
+# with IDENTITY_URL in load_balancing/light_client.py set to                      #
+# http://127.0.0.1:8900/v2.0/tokens (or pyrax's auth_endpoint setting to          #
+# http://127.0.0.1:8900/v2.0/) to point the scripts at it.                        #
+#                                                                                 #
+# License: Apache License Version 2.0 http://www.apache.org/licenses/LICENSE-2.0  #
+###################################################################################
+
+from __future__ import print_function
+
+import re
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from urlparse import urlparse, parse_qs
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+TENANT = '123456'
+REGION = 'DFW'
+GROUP_ID = 'f0a7b3e2-4c5d-4e6f-8a9b-0c1d2e3f4a5b'
+LB_ID = 100001
+SCALE_UP_POLICY = 'a1b2c3d4-0000-4000-8000-000000000001'
+SCALE_DOWN_POLICY = 'a1b2c3d4-0000-4000-8000-000000000002'
+
+# Path segments that are IDs, replaced when counting requests by endpoint
+ID_SEGMENT = re.compile(r'/(?:[0-9a-fA-F-]{32,36}|\d+)(?=/|$)')
+
+
+class ApiError(Exception):
+
+    def __init__(self, code, message):
+        self.code = code
+        self.message = message
+        super(ApiError, self).__init__(message)
+
+
+class FakeCloud(object):
+    """ In-memory state of the fake account.
+        nodes is the number of servers in the scaling group, all of them
+        ONLINE nodes in the load balancer. stray_nodes more nodes in the load
+        balancer belong to servers no longer in the group. other_servers are
+        servers in the account outside the group, which are listed along
+        with the group's servers.
+    """
+
+    def __init__(self, nodes=10, stray_nodes=0, other_servers=0,
+                 latency=0.0, pending_update=0.0, error_rate=0.0,
+                 lb_port=80):
+        self.latency = latency
+        self.pending_update = pending_update
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.calls = {}
+        # Error responses by status code
+        self.errors = {}
+        self.next_node_id = 1
+
+        self.servers = []
+        for i in range(other_servers):
+            self.servers.append(self.make_server(
+                'other-%d' % i, '10.177.%d.%d' % divmod(i, 250)))
+        group_servers = []
+        for i in range(nodes):
+            server = self.make_server('autoscaled-%d' % i,
+                                      '10.176.%d.%d' % divmod(i, 250))
+            group_servers.append(server)
+            self.servers.append(server)
+        # The account's servers are listed in ID order
+        self.servers.sort(key=lambda s: s['id'])
+        self.servers_by_id = dict((s['id'], s) for s in self.servers)
+
+        self.group = {
+            'id': GROUP_ID,
+            'active': [s['id'] for s in group_servers],
+            'desiredCapacity': nodes,
+            'pendingCapacity': 0,
+            'paused': False,
+            'groupConfiguration': {'name': 'autoscale_group',
+                                   'cooldown': 10,
+                                   'minEntities': 2,
+                                   'maxEntities': max(16, nodes * 2),
+                                   'metadata': {}},
+            'launchConfiguration': {
+                'type': 'launch_server',
+                'args': {'server': {
+                    'name': 'autoscaled_server',
+                    'imageRef': '09de0a66-3156-48b4-90a5-1cf25a905207',
+                    'flavorRef': 'performance1-1',
+                    'OS-DCF:diskConfig': 'MANUAL',
+                    'metadata': {}}}},
+            'scalingPolicies': [
+                self.make_policy(SCALE_UP_POLICY, 'scale_up', 2),
+                self.make_policy(SCALE_DOWN_POLICY, 'scale_down', -2)],
+        }
+
+        self.lb = {'id': LB_ID, 'name': 'autoscale_lb', 'port': lb_port,
+                   'protocol': 'HTTP', 'status': 'ACTIVE', 'nodes': [],
+                   'pending_until': 0}
+        self.health_monitor = {'type': 'CONNECT', 'delay': 1, 'timeout': 5,
+                               'attemptsBeforeDeactivation': 1}
+        for server in group_servers:
+            self.add_node(self.get_address(server), lb_port, 'ENABLED',
+                          'ONLINE')
+        for i in range(stray_nodes):
+            self.add_node('10.175.%d.%d' % divmod(i, 250), lb_port,
+                          'ENABLED', 'OFFLINE')
+
+    def make_server(self, name, address):
+        return {'id': str(uuid.uuid4()), 'name': name, 'status': 'ACTIVE',
+                'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'addresses': {'private': [{'addr': address, 'version': 4}]},
+                'metadata': {}}
+
+    def make_policy(self, policy_id, name, change):
+        return {'id': policy_id, 'name': name, 'change': change,
+                'cooldown': 10, 'type': 'webhook',
+                'links': [{'rel': 'self', 'href': policy_id}]}
+
+    def get_address(self, server):
+        return server['addresses']['private'][0]['addr']
+
+    def add_node(self, address, port, condition, status='ONLINE'):
+        node = {'id': self.next_node_id, 'address': address, 'port': port,
+                'condition': condition, 'status': status, 'type': 'PRIMARY',
+                'weight': 1}
+        self.next_node_id += 1
+        self.lb['nodes'].append(node)
+        return node
+
+    def count(self, method, path):
+        key = '%s %s' % (method, ID_SEGMENT.sub('/{id}', path))
+        with self.lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+    def count_error(self, code):
+        with self.lock:
+            self.errors[code] = self.errors.get(code, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            return {'calls': dict(self.calls),
+                    'total': sum(self.calls.values()),
+                    'errors_by_code': dict(self.errors),
+                    'errors': sum(self.errors.values())}
+
+    def reset_stats(self):
+        with self.lock:
+            self.calls = {}
+            self.errors = {}
+
+    # Load balancers
+
+    def lb_status(self):
+        if time.time() < self.lb['pending_until']:
+            return 'PENDING_UPDATE'
+        return 'ACTIVE'
+
+    def change_lb(self):
+        """ Called with the lock held before every change to the load
+            balancer, which then stays immutable for pending_update seconds
+        """
+        if self.lb_status() != 'ACTIVE':
+            raise ApiError(422, "Load Balancer '%s' has a status of"
+                                " 'PENDING_UPDATE' and is considered"
+                                " immutable." % LB_ID)
+        self.lb['pending_until'] = time.time() + self.pending_update
+
+    def get_lb(self):
+        with self.lock:
+            lb = dict((k, v) for k, v in self.lb.iteritems()
+                      if k != 'pending_until')
+            lb['status'] = self.lb_status()
+            lb['nodes'] = [dict(node) for node in self.lb['nodes']]
+            lb['nodeCount'] = len(lb['nodes'])
+            if not lb['nodes']:
+                del lb['nodes']
+            return {'loadBalancer': lb}
+
+    def get_lb_stats(self):
+        # Nothing connects to the fake load balancer
+        return {'connectTimeOut': 0, 'connectError': 0, 'connectFailure': 0,
+                'dataTimedOut': 0, 'keepAliveTimedOut': 0, 'maxConn': 0,
+                'currentConn': 0}
+
+    def add_lb_nodes(self, body):
+        with self.lock:
+            existing = set((n['address'], n['port'])
+                           for n in self.lb['nodes'])
+            for node in body['nodes']:
+                if (node['address'], node['port']) in existing:
+                    raise ApiError(422, "Duplicate nodes detected. One or"
+                                        " more nodes already configured on"
+                                        " load balancer.")
+            self.change_lb()
+            added = [self.add_node(n['address'], n['port'],
+                                   n.get('condition', 'ENABLED'))
+                     for n in body['nodes']]
+            return {'nodes': [dict(n) for n in added]}
+
+    def find_node(self, node_id):
+        for node in self.lb['nodes']:
+            if node['id'] == node_id:
+                return node
+        raise ApiError(404, "Node not found")
+
+    def update_lb_node(self, node_id, body):
+        with self.lock:
+            node = self.find_node(node_id)
+            self.change_lb()
+            node.update(body['node'])
+
+    def delete_lb_node(self, node_id):
+        with self.lock:
+            node = self.find_node(node_id)
+            self.change_lb()
+            self.lb['nodes'].remove(node)
+
+    # Servers
+
+    def list_servers(self, query):
+        limit = int(query.get('limit', ['1000'])[0])
+        marker = query.get('marker', [None])[0]
+        start = 0
+        if marker:
+            ids = [s['id'] for s in self.servers]
+            if marker not in ids:
+                raise ApiError(400, "marker [%s] not found" % marker)
+            start = ids.index(marker) + 1
+        return {'servers': self.servers[start:start + limit]}
+
+    def get_server(self, server_id):
+        if server_id not in self.servers_by_id:
+            raise ApiError(404, "Instance could not be found")
+        return {'server': self.servers_by_id[server_id]}
+
+    # Autoscale
+
+    def get_group(self, base_url):
+        group = dict(self.group)
+        group['state'] = self.get_state()['group']
+        group['links'] = [{'rel': 'self', 'href': '%s/groups/%s/' % (
+            base_url, GROUP_ID)}]
+        return {'group': group}
+
+    def get_state(self):
+        return {'group': {
+            'id': GROUP_ID, 'name': self.group['groupConfiguration']['name'],
+            'active': [{'id': sid, 'links': []}
+                       for sid in self.group['active']],
+            'activeCapacity': len(self.group['active']),
+            'desiredCapacity': self.group['desiredCapacity'],
+            'pendingCapacity': self.group['pendingCapacity'],
+            'paused': self.group['paused']}}
+
+    def get_policy(self, policy_id):
+        for policy in self.group['scalingPolicies']:
+            if policy['id'] == policy_id:
+                return policy
+        raise ApiError(404, "Policy not found")
+
+    def get_webhook(self, base_url, policy_id, webhook_id=None):
+        webhook_id = webhook_id or policy_id.replace('a1b2c3d4', 'b1b2c3d4')
+        return {'id': webhook_id, 'name': 'webhook', 'metadata': {},
+                'links': [{'rel': 'self', 'href': webhook_id},
+                          {'rel': 'capability',
+                           'href': '%s/execute/1/%s/' % (base_url,
+                                                          webhook_id)}]}
+
+
+class FakeApiServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # Plenty of servers add themselves at once in the larger scenarios
+    request_queue_size = 128
+
+    def __init__(self, cloud, address=('127.0.0.1', 0)):
+        HTTPServer.__init__(self, address, FakeApiHandler)
+        self.cloud = cloud
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def identity_url(self):
+        return self.url + '/v2.0/tokens'
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # Service type, name and path prefix of each endpoint in the catalog
+    SERVICES = (('compute', 'cloudServersOpenStack', '/servers/v2'),
+                ('rax:autoscale', 'autoscale', '/autoscale/v1.0'),
+                ('rax:load-balancer', 'cloudLoadBalancers',
+                 '/loadbalancers/v1.0'))
+
+    def do_GET(self):
+        self.handle_api('GET')
+
+    def do_POST(self):
+        self.handle_api('POST')
+
+    def do_PUT(self):
+        self.handle_api('PUT')
+
+    def do_DELETE(self):
+        self.handle_api('DELETE')
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        if not length:
+            return None
+        return json.loads(self.rfile.read(length))
+
+    def send_json(self, code, body=None):
+        data = json.dumps(body) if body is not None else ''
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_api(self, method):
+        cloud = self.server.cloud
+        parsed = urlparse(self.path)
+        path = parsed.path.rstrip('/')
+        query = parse_qs(parsed.query)
+        body = self.read_body()
+
+        if path == '/_stats':
+            if method == 'POST':
+                cloud.reset_stats()
+            return self.send_json(200, cloud.stats())
+
+        cloud.count(method, path)
+        if cloud.latency:
+            time.sleep(cloud.latency)
+        try:
+            if path != '/v2.0/tokens' and random.random() < cloud.error_rate:
+                raise ApiError(503, "Service Unavailable (injected)")
+            code, response = self.route(method, path, query, body)
+        except ApiError as ex:
+            code, response = ex.code, {'message': ex.message, 'code': ex.code}
+            cloud.count_error(code)
+        self.send_json(code, response)
+
+    def route(self, method, path, query, body):
+        cloud = self.server.cloud
+        if path == '/v2.0/tokens' and method == 'POST':
+            return 200, self.get_access(body)
+        if not self.headers.getheader('x-auth-token'):
+            raise ApiError(401, "No auth token")
+
+        for service_type, name, prefix in self.SERVICES:
+            prefix = '%s/%s' % (prefix, TENANT)
+            if path.startswith(prefix):
+                base_url = self.server.url + prefix
+                sub_path = path[len(prefix):]
+                break
+        else:
+            raise ApiError(404, "Unknown endpoint")
+        segments = sub_path.strip('/').split('/')
+
+        if service_type == 'compute':
+            if segments == ['servers', 'detail'] and method == 'GET':
+                return 200, cloud.list_servers(query)
+            if len(segments) == 2 and segments[0] == 'servers' and \
+               method == 'GET':
+                return 200, cloud.get_server(segments[1])
+
+        elif service_type == 'rax:load-balancer':
+            if segments[:2] != ['loadbalancers', str(LB_ID)]:
+                raise ApiError(404, "Load balancer not found")
+            rest = segments[2:]
+            if not rest and method == 'GET':
+                return 200, cloud.get_lb()
+            if rest == ['healthmonitor'] and method == 'GET':
+                return 200, {'healthMonitor': cloud.health_monitor}
+            if rest == ['stats'] and method == 'GET':
+                return 200, cloud.get_lb_stats()
+            if rest == ['nodes'] and method == 'POST':
+                return 202, cloud.add_lb_nodes(body)
+            if len(rest) == 2 and rest[0] == 'nodes':
+                if method == 'PUT':
+                    cloud.update_lb_node(int(rest[1]), body)
+                    return 202, None
+                if method == 'DELETE':
+                    cloud.delete_lb_node(int(rest[1]))
+                    return 202, None
+
+        elif service_type == 'rax:autoscale':
+            if segments == ['groups'] and method == 'GET':
+                return 200, {'groups': [cloud.get_state()['group']],
+                             'groups_links': []}
+            if segments[:2] != ['groups', GROUP_ID]:
+                raise ApiError(404, "Scaling group not found")
+            rest = segments[2:]
+            if method == 'PUT':
+                # Updates are accepted, but the fake group doesn't change
+                return 204, None
+            if not rest:
+                return 200, cloud.get_group(base_url)
+            if rest == ['state']:
+                return 200, cloud.get_state()
+            if rest == ['config']:
+                return 200, {'groupConfiguration':
+                             cloud.group['groupConfiguration']}
+            if rest == ['launch']:
+                return 200, {'launchConfiguration':
+                             cloud.group['launchConfiguration']}
+            if rest == ['policies']:
+                return 200, {'policies': cloud.group['scalingPolicies'],
+                             'policies_links': []}
+            if len(rest) >= 2 and rest[0] == 'policies':
+                policy = cloud.get_policy(rest[1])
+                if len(rest) == 2:
+                    return 200, {'policy': policy}
+                if rest[2:] == ['webhooks']:
+                    return 200, {'webhooks': [cloud.get_webhook(
+                        base_url, policy['id'])], 'webhooks_links': []}
+                if len(rest) == 4 and rest[2] == 'webhooks':
+                    return 200, {'webhook': cloud.get_webhook(
+                        base_url, policy['id'], rest[3])}
+
+        raise ApiError(404, "Unknown endpoint")
+
+    def get_access(self, body):
+        try:
+            username = body['auth']['RAX-KSKEY:apiKeyCredentials']['username']
+        except (TypeError, KeyError):
+            raise ApiError(400, "Invalid authentication request")
+        expires = time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+                                time.gmtime(time.time() + 86400))
+        catalog = [{'type': service_type, 'name': name,
+                    'endpoints': [{'region': REGION, 'tenantId': TENANT,
+                                   'publicURL': '%s%s/%s' % (
+                                       self.server.url, prefix, TENANT)}]}
+                   for service_type, name, prefix in self.SERVICES]
+        return {'access': {
+            'token': {'id': uuid.uuid4().hex, 'expires': expires,
+                      'tenant': {'id': TENANT, 'name': TENANT}},
+            'serviceCatalog': catalog,
+            'user': {'id': '1', 'name': username,
+                     'RAX-AUTH:defaultRegion': REGION,
+                     'roles': []}}}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        'Serve a fake Rackspace Cloud API on localhost')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--nodes', type=int, default=10,
+                        help='Servers in the scaling group (default 10)')
+    parser.add_argument('--stray-nodes', type=int, default=0,
+                        help='Load balancer nodes of servers no longer in'
+                             ' the group (default 0)')
+    parser.add_argument('--other-servers', type=int, default=0,
+                        help='Servers in the account outside the group'
+                             ' (default 0)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds to delay every request by')
+    parser.add_argument('--pending-update', type=float, default=0.0,
+                        help='Seconds the load balancer stays in'
+                             ' PENDING_UPDATE after every change')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Share of requests (0-1) to fail with a 503')
+    args = parser.parse_args()
+
+    cloud = FakeCloud(nodes=args.nodes, stray_nodes=args.stray_nodes,
+                      other_servers=args.other_servers, latency=args.latency,
+                      pending_update=args.pending_update,
+                      error_rate=args.error_rate)
+    server = FakeApiServer(cloud, ('127.0.0.1', args.port))
+    print("Serving on %s (identity at %s, group %s, load balancer %s)" % (
+        server.url, server.identity_url(), GROUP_ID, LB_ID))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
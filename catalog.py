@@ -0,0 +1,130 @@
+""" This module keeps the collections --create-config lets the user pick
+    from (scaling groups, images, flavors, keypairs, networks and load
+    balancers). The ones that are going to be needed are fetched
+    concurrently in the background as soon as the wizard starts, and kept
+    on disk for CACHE_TTL seconds, so that the prompts don't wait on a
+    slow list call (e.g. images on a large account) every time.
+"""
+import os
+import json
+import time
+import hashlib
+from multiprocessing.pool import ThreadPool
+from load_balancing import token_cache
+
+# Seconds a fetched collection is used for before it is fetched again
+CACHE_TTL = 600
+
+# Functions returning the pyrax manager to list each collection from
+COLLECTIONS = {
+    'groups': lambda pyrax: pyrax.autoscale,
+    'images': lambda pyrax: pyrax.images,
+    'flavors': lambda pyrax: pyrax.cloudservers.flavors,
+    'keypairs': lambda pyrax: pyrax.cloudservers.keypairs,
+    'networks': lambda pyrax: pyrax.cloud_networks,
+    'load_balancers': lambda pyrax: pyrax.cloud_loadbalancers,
+}
+
+
+class Entry(object):
+    """ The name and ID of an object in a collection, which is all the
+        pick-lists need
+    """
+
+    def __init__(self, name, id):
+        self.name = name
+        self.id = id
+
+
+def get_cache_file(cache_dir, username, region):
+    return os.path.join(cache_dir, 'catalog-%s-%s.json' % (
+                        hashlib.sha1(username).hexdigest(), region))
+
+
+def list_objects(manager):
+    try:
+        # Most objects have a list_all method, but fall back to .list() if not
+        objects = manager.list_all()
+    except AttributeError:
+        objects = manager.list()
+    return [Entry(obj.name, obj.id) for obj in objects]
+
+
+class Catalog(object):
+    """ Collections listed from the API, cached per user and region """
+
+    def __init__(self, pyrax, username, region,
+                 cache_dir=token_cache.DEFAULT_CACHE_DIR, ttl=CACHE_TTL):
+        self.pyrax = pyrax
+        self.cache_file = get_cache_file(cache_dir, username, region)
+        self.ttl = ttl
+        self.cache = self.read_cache()
+        # Collection name -> AsyncResult of a fetch started by prefetch()
+        self.pending = {}
+        self.pool = None
+
+    def read_cache(self):
+        """ Returns the collections on disk, as {name: {'time': fetched at,
+            'entries': [[name, id], ...]}}
+        """
+        try:
+            with open(self.cache_file, 'r') as fp:
+                return json.load(fp)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def is_fresh(self, name):
+        cached = self.cache.get(name)
+        return bool(cached) and cached['time'] + self.ttl > time.time()
+
+    def fetch(self, name):
+        return list_objects(COLLECTIONS[name](self.pyrax))
+
+    def prefetch(self, names):
+        """ Starts fetching the collections that aren't cached, in the
+            background. get() waits for them
+        """
+        names = [n for n in names
+                 if not self.is_fresh(n) and n not in self.pending]
+        if not names:
+            return
+        if not self.pool:
+            self.pool = ThreadPool(len(COLLECTIONS))
+        for name in names:
+            self.pending[name] = self.pool.apply_async(self.fetch, (name,))
+
+    def get(self, name):
+        """ Returns the collection as a list of Entry objects """
+        if name in self.pending:
+            try:
+                entries = self.pending.pop(name).get()
+            except Exception:
+                # Fetched again below, so an error is raised where the
+                # collection is needed, as if it hadn't been prefetched
+                entries = None
+            if entries is not None:
+                self.store(name, entries)
+                return entries
+
+        if self.is_fresh(name):
+            return [Entry(n, i) for n, i in self.cache[name]['entries']]
+
+        entries = self.fetch(name)
+        self.store(name, entries)
+        return entries
+
+    def invalidate(self, name):
+        """ Drops a collection, e.g. after an object has been added to it """
+        self.cache.pop(name, None)
+        token_cache.write_cache(self.cache_file, self.cache)
+
+    def store(self, name, entries):
+        self.cache[name] = {'time': time.time(),
+                            'entries': [[e.name, e.id] for e in entries]}
+        token_cache.write_cache(self.cache_file, self.cache)
+
+    def close(self):
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
@@ -3,11 +3,32 @@
     Invoked by --create-config
 """
 import utils
+import catalog
 from colors import bcolors, print_msg
 from jinja2 import Environment
 import os
 
 
+def get_needed_collections(config):
+    """ Returns the names of the catalog.COLLECTIONS the user will be asked
+        to pick from, given what's missing from the config
+    """
+    needed = []
+    if not config.as_config.id:
+        needed.append('groups')
+    if not config.lc_config.image:
+        needed.append('images')
+    if not config.lc_config.flavor:
+        needed.append('flavors')
+    if not config.lc_config.key_name:
+        needed.append('keypairs')
+    if not isinstance(config.lc_config.networks, list):
+        needed.append('networks')
+    if not isinstance(config.ras_config.load_balancers, list):
+        needed.append('load_balancers')
+    return needed
+
+
 def write_config(config, pyrax):
     """ Prompt for missing keys in the config file and writes a new one out """
 
@@ -24,12 +45,18 @@ def write_config(config, pyrax):
     except AttributeError:
         pass
 
+    # Start listing what the user will be asked to pick from, while they
+    # answer the other questions
+    username, _, region = config.get_credentials()
+    objects = catalog.Catalog(pyrax, username, region)
+    objects.prefetch(get_needed_collections(config))
+
     ##
     # Write [autoscale] config
     ##
     if not config.as_config.id:
         group = utils.get_object_from_list(
-            pyrax.autoscale, "group", create_new_option=True)
+            objects.get('groups'), "group", create_new_option=True)
         if group is not None:
             config.set_config_option('autoscale', 'id', group)
 
@@ -76,22 +103,23 @@ def write_config(config, pyrax):
     # Write [launch-config] config
     ##
     if not config.lc_config.image:
-        image = utils.get_object_from_list(pyrax.images, "image")
+        image = utils.get_object_from_list(objects.get('images'), "image")
         config.set_config_option('launch-configuration', 'image', image)
 
     if not config.lc_config.flavor:
         flavor = utils.get_object_from_list(
-            pyrax.cloudservers.flavors, "flavor")
+            objects.get('flavors'), "flavor")
         config.set_config_option('launch-configuration', 'flavor', flavor)
 
     if not config.lc_config.key_name:
         key_name = utils.get_object_from_list(
-            pyrax.cloudservers.keypairs, "ssh-key to add to"
-                                         " /root/.ssh/authorized_keys on"
-                                         " the servers",
-                                         create_new_option=True)
+            objects.get('keypairs'), "ssh-key to add to"
+                                     " /root/.ssh/authorized_keys on"
+                                     " the servers",
+                                     create_new_option=True)
         if key_name is None:
             key_name = utils.add_new_key(pyrax)
+            objects.invalidate('keypairs')
         config.set_config_option('launch-configuration', 'key_name', key_name)
 
     if not config.lc_config.name:
@@ -116,7 +144,7 @@ def write_config(config, pyrax):
                         "attach the cloud servers to", bcolors.QUESTION)
         while True:
             network = utils.get_object_from_list(
-                pyrax.cloud_networks, "network", quit_option=True)
+                objects.get('networks'), "network", quit_option=True)
             if network and network not in networks:
                 networks.append(str(network))
             elif network:
@@ -156,7 +184,8 @@ def write_config(config, pyrax):
                         " attach the cloud servers to", bcolors.QUESTION)
         while True:
             load_balancer = utils.get_object_from_list(
-                pyrax.cloud_loadbalancers, "load balancer", quit_option=True)
+                objects.get('load_balancers'), "load balancer",
+                quit_option=True)
             if load_balancer and load_balancer not in load_balancers:
                 load_balancers.append(load_balancer)
             elif load_balancer:
@@ -190,7 +219,11 @@ def write_config(config, pyrax):
         config.set_config_option('rax-autoscaler', 'admin_server',
                                  admin_server)
 
-    # Re-parse the file on-disk and validate
+    objects.close()
+
+    # Write out everything set above in one go, then re-parse the file
+    # on-disk and validate
+    config.flush()
     config.parse_config()
     config.validate()
 
@@ -216,6 +249,8 @@ def generate_rax_as_config(config):
 
     num_static_servers = config.cfg.get('rax-autoscaler',
                                         'num_static_servers')
+    reconcile_url = (config.get('rax-autoscaler', 'reconcile_url') or
+                     '').strip("'")
 
     t = j2_env.render(username=config.username,
                       api_key=config.api_key,
@@ -224,7 +259,8 @@ def generate_rax_as_config(config):
                       scale_up_policy=scale_up_policy,
                       scale_down_policy=scale_down_policy,
                       load_balancers=load_balancers,
-                      num_static_servers=num_static_servers)
+                      num_static_servers=num_static_servers,
+                      reconcile_url=reconcile_url)
 
     try:
         with open(output_file, 'w+') as fp:
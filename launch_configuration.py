@@ -6,6 +6,22 @@ class LaunchConfig(object):
         configuration.
     """
 
+    section = 'launch-configuration'
+    # Type of each key, and whether it is required. The flavor can be given
+    # by name or id
+    schema = {'name': (basestring, True),
+              'networks': (list, True),
+              'key_name': (basestring, True),
+              'disk_config': (basestring, True),
+              'cloud_init': (basestring, False),
+              'metadata': (dict, True),
+              'flavor': (object, True),
+              'image': (basestring, True),
+              'user_data': (basestring, False),
+              'config_drive': (bool, True),
+              'skip_default_networks': (bool, True),
+              'type': (basestring, True)}
+
     def __init__(self):
         pass
     name = None
@@ -23,38 +39,10 @@ class LaunchConfig(object):
     type = 'launch_server'
 
     def validate(self):
-        """ Iterates over class attributes and verifies that they have been set
-        during the config parsing or config writing process
+        """ Verifies that the attributes have been set to values of the
+        right type during the config parsing or config writing process
         """
-
-        ok_missing = ['user_data', 'networks']
-        for obj in [obj for obj in dir(self) if not
-                    obj.startswith('__') and obj not in ok_missing]:
-            if getattr(self, obj) is None:
-                raise AttributeError("Config file parsing failed - key %s"
-                                     " is missing or has no value in section"
-                                     " 'launch-configuration'"
-                                     " Try re-running with --create-config" %
-                                     obj)
-
-        if not isinstance(self.metadata, dict):
-            raise AttributeError(utils.get_parse_error('metadata',
-                                                       'launch-configuration',
-                                                       'dictionary'))
-        if not isinstance(self.image, str):
-            raise AttributeError(utils.get_parse_error('image',
-                                                       'launch-configuration',
-                                                       'string'))
-
-        if not isinstance(self.networks, list):
-            raise AttributeError(utils.get_parse_error('networks',
-                                                       'launch-configuration',
-                                                       'list'))
-
-        if not isinstance(self.skip_default_networks, bool):
-            raise AttributeError(utils.get_parse_error('skip_default_networks',
-                                                       'launch-configuration',
-                                                       'boolean'))
+        utils.check_section(self)
 
         if self.cloud_init and self.cloud_init is not '':
             if not utils.is_readable(self.cloud_init):
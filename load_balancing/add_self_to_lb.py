@@ -17,13 +17,19 @@
 from __future__ import print_function
 
 import os
-import pyrax
+import argparse
 import netifaces as ni
 import urllib2
+import httplib
 import socket
+import time
 import re
-import random
-from time import sleep
+import json
+from multiprocessing.pool import ThreadPool
+from retry_policy import RetryPolicy, NotReady
+import timing
+from timing import PhaseTimer
+import token_cache
 
 ####################### CONFIGURATION #######################
 
@@ -58,6 +64,51 @@ host_header = None
 # Protocol to utilise in url check (override LB health check) (optional)
 protocol = None
 
+# Seconds to keep retrying while the load balancer is busy with other
+# updates, e.g. other servers adding themselves during a scale-up (optional)
+retry_deadline = 120
+
+# URL of node_coordinator.py on the admin server (optional). If set, the node
+# reports to the coordinator once healthy and is added to the load balancer(s)
+# together with other servers that became ready at the same time, rather than
+# adding itself.
+# e.g. coordinator_url = "http://10.0.0.1:8910/nodes"
+coordinator_url = None
+
+# auth_token of node_coordinator.py, sent with every report to it (required
+# with coordinator_url)
+coordinator_token = None
+
+# Talk to the API through the bundled light_client.py rather than pyrax,
+# which is much quicker to import (optional)
+lightweight_client = False
+
+# File to record the duration, status and retries of every API call in
+# (optional). Written in the Prometheus text format if the name ends in .prom,
+# and as JSON lines otherwise. Can be overridden with --metrics-file
+# e.g. metrics_file = "/var/log/add_self_to_lb.metrics.json"
+metrics_file = None
+
+# Seconds to keep repeating the health check before giving up on a load
+# balancer, e.g. while the application is still starting up (optional)
+health_check_deadline = 600
+
+# Maximum number of bytes of the response body to search for the health
+# check's bodyRegex (optional)
+max_body_size = 1048576
+
+# Number of bytes at the end of what has been read so far that are searched
+# again along with the next chunk, so that a match spanning two chunks is
+# still found. Must be at least as long as the longest match expected
+# (optional)
+match_overlap = 4096
+
+# URL to send the times this server booted, passed the health check and was
+# added to the load balancer(s) to (optional). This is the /readiness path of
+# remove_dead_nodes.py --listen on the admin server, see readiness.py.
+# e.g. readiness_url = "http://10.0.0.1:8911/readiness"
+readiness_url = None
+
 ######################################################################
 
 
@@ -72,80 +123,294 @@ def health_check(health_check, port=80):
         print ("No health check present on load balancer")
         return
 
-    if health_check.get('type') == 'CONNECT':
-        check_port(addr, port, health_check.get('timeout'))
-    elif health_check.get('type') in ['HTTP', 'HTTPS']:
-        check_url(health_check, addr)
-    else:
+    if health_check.get('type') not in ['CONNECT', 'HTTP', 'HTTPS']:
         raise Exception("Unsupported health check, please implement your own")
+    HealthCheck(health_check, addr, port).wait_until_healthy(
+        health_check_deadline)
 
 def check_port(addr, port, timeout):
    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
    sock.settimeout(timeout)
-   result = sock.connect_ex((addr, port))
+   try:
+       result = sock.connect_ex((addr, port))
+   finally:
+       sock.close()
    if result != 0:
        raise Exception("Error connecting to port %s: error: %s" % (port, result))
    return result
 
-def check_url(health_check, addr):
-    global host_header
-    expected_resp = re.compile(health_check.get('bodyRegex', '.*'))
-    expected_code = re.compile(health_check.get('statusRegex', '.*'))
-    proto = protocol if protocol else health_check.get('type').lower()
-    url = ("%s://%s/%s" % (proto, addr, health_check.get('path', '/')))
 
-    if not host_header:
-        host_header = addr
-    headers = { 'Host': host_header }
+class HealthCheck(object):
+    """ Replicates a load balancer health monitor locally. Like the load
+        balancer, it probes every 'delay' seconds with a 'timeout', and only
+        considers the node healthy after 'attemptsBeforeDeactivation'
+        consecutive successful probes. HTTP(S) probes reuse one keep-alive
+        connection, and stop reading the body as soon as bodyRegex matches.
+    """
+
+    def __init__(self, monitor, addr, port):
+        self.monitor = monitor
+        self.addr = addr
+        self.port = port
+        self.timeout = monitor.get('timeout') or 10
+        self.delay = monitor.get('delay') or 10
+        self.required_passes = monitor.get('attemptsBeforeDeactivation') or 1
+        self.expected_resp = re.compile(monitor.get('bodyRegex') or '.*')
+        self.expected_code = re.compile(monitor.get('statusRegex') or '.*')
+        self.proto = protocol if protocol else monitor.get('type').lower()
+        self.path = '/' + (monitor.get('path') or '/').lstrip('/')
+        self.conn = None
+
+    def connect(self):
+        if self.proto == 'https':
+            return httplib.HTTPSConnection(self.addr, timeout=self.timeout)
+        return httplib.HTTPConnection(self.addr, timeout=self.timeout)
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+    def check_url(self):
+        if not self.conn:
+            self.conn = self.connect()
+        headers = { 'Host': host_header if host_header else self.addr }
+        try:
+            self.conn.request('GET', self.path, headers=headers)
+            response = self.conn.getresponse()
+        except (httplib.HTTPException, socket.error):
+            self.close()
+            raise
+
+        if not self.expected_code.match(str(response.status)):
+            self.close()
+            raise Exception("check_url(): Response status %s does not match"
+                            " expected result" % response.status)
+
+        # Read the body in chunks, and stop searching as soon as the regex
+        # matches. Each chunk is searched along with the last match_overlap
+        # bytes before it, rather than everything read so far
+        tail = ''
+        read = 0
+        matched = False
+        while read < max_body_size:
+            chunk = response.read(min(8192, max_body_size - read))
+            if not chunk:
+                break
+            read += len(chunk)
+            if not matched:
+                window = tail + chunk
+                matched = bool(self.expected_resp.search(window))
+                # The rest is only read (and discarded) once matched, so
+                # that the connection can be reused for the next probe
+                tail = window[-match_overlap:] if match_overlap > 0 else ''
+
+        # An empty body can still match, e.g. the default regex
+        if not matched and not read:
+            matched = bool(self.expected_resp.search(''))
+
+        # A response larger than max_body_size can't be consumed entirely
+        if not response.isclosed():
+            self.close()
+
+        if not matched:
+            raise Exception("check_url(): Response content does not match expected result")
+        return True
+
+    def probe(self):
+        if self.monitor.get('type') == 'CONNECT':
+            return check_port(self.addr, self.port, self.timeout)
+        return self.check_url()
+
+    def wait_until_healthy(self, deadline):
+        """ Probes until enough consecutive probes have passed. Raises the
+            last error if that doesn't happen within deadline seconds
+        """
+        give_up_at = time.time() + deadline
+        passes = 0
+        try:
+            while True:
+                try:
+                    self.probe()
+                    passes += 1
+                    if passes >= self.required_passes:
+                        return True
+                except Exception:
+                    passes = 0
+                    if time.time() + self.delay > give_up_at:
+                        raise
+                time.sleep(self.delay)
+        finally:
+            self.close()
+
+
+def get_boot_time():
+    with open('/proc/uptime', 'r') as fp:
+        return time.time() - float(fp.read().split()[0])
+
+
+def report_readiness(my_ip, results):
+    """ Sends when this server booted, passed the health check(s) and went
+        into service to readiness_url. The last load balancer to pass or
+        accept the node counts
+    """
+    healthy = [r.healthy_at for r in results]
+    added = [r.added_at for r in results]
+    data = json.dumps({
+        'address': my_ip,
+        'booted': get_boot_time(),
+        'healthy': max(healthy) if None not in healthy else None,
+        'in_service': max(added) if None not in added else None})
+    req = urllib2.Request(readiness_url, data,
+                          {'Content-Type': 'application/json'})
+    urllib2.urlopen(req, timeout=10).read()
 
-    req = urllib2.Request(url, headers=headers)
-    response = urllib2.urlopen(req)
 
-    contents_result = expected_resp.search(response.read())
-    status_result = expected_code.match(str(response.getcode()))
+def report_ready(lb_id, my_ip):
+    data = json.dumps({'lb_id': lb_id, 'address': my_ip})
+    req = urllib2.Request(coordinator_url, data,
+                          {'Content-Type': 'application/json',
+                           'X-Auth-Token': coordinator_token or ''})
+    urllib2.urlopen(req, timeout=10).read()
 
-    if not contents_result or not status_result:
-        raise Exception("check_url(): Response content does not match expected result")
 
-    return True
+class Registration(object):
+    """ Outcome of adding this node to a single load balancer """
+    ADDED = 'added'
+    PRESENT = 'already present'
+    QUEUED = 'reported to coordinator'
+    UNHEALTHY = 'health check failed'
+    FAILED = 'failed'
+
+    def __init__(self, lb_id):
+        self.lb_id = lb_id
+        self.status = None
+        self.message = None
+        # When the health check passed and the node was added
+        self.healthy_at = None
+        self.added_at = None
+
+
+@timing.timed('register')
+def register(api, lb_id, my_ip):
+    """ Runs the health check of one load balancer locally and adds this node
+        to it if it passes. Returns a Registration
+    """
+    clb = api.cloud_loadbalancers
+    result = Registration(lb_id)
+    policy = RetryPolicy(deadline=retry_deadline)
+    try:
+        lb = clb.get(lb_id)
+        health_check(lb.get_health_monitor(), lb.port)
+    except Exception as e:
+        result.status = Registration.UNHEALTHY
+        result.message = str(e)
+        return result
+    result.healthy_at = time.time()
+
+    if coordinator_url:
+        try:
+            report_ready(lb_id, my_ip)
+            result.status = Registration.QUEUED
+        except Exception as e:
+            result.status = Registration.FAILED
+            result.message = "Unable to reach coordinator: %s" % e
+        return result
+
+    def add_node():
+        policy.wait_until(lb, "status", "ACTIVE")
+        node = clb.Node(address = my_ip, port = lb.port, condition = "ENABLED")
+        lb.add_nodes([node])
+
+    try:
+        policy.call(add_node)
+        result.status = Registration.ADDED
+        result.added_at = time.time()
+    except api.exceptions.ClientException as e:
+        if "Duplicate nodes" in e.message:
+            result.status = Registration.PRESENT
+            result.message = "%s:%s" % (my_ip, lb.port)
+        else:
+            result.status = Registration.FAILED
+            result.message = e.message
+    except NotReady as e:
+        result.status = Registration.FAILED
+        result.message = str(e)
+    return result
+
+
+def get_api(timer):
+    """ Returns the authenticated pyrax module, or the lightweight stand-in
+        for it. pyrax is only imported when it is going to be used
+    """
+    if lightweight_client:
+        with timer.phase('import'):
+            import light_client
+        with timer.phase('auth'):
+            return light_client.connect(credentials)
+
+    with timer.phase('import'):
+        import pyrax
+    with timer.phase('auth'):
+        pyrax.set_setting("identity_type", "rackspace")
+        token_cache.authenticate(pyrax, credential_file=credentials)
+    return pyrax
 
 
 def main():
+    parser = argparse.ArgumentParser(
+        'Add this server to its load balancer(s) once healthy')
+    parser.add_argument('--profile-startup', required=False,
+                        action="store_true",
+                        help='Report the time spent importing modules,'
+                             ' authenticating and making API calls')
+    parser.add_argument('--metrics-file', type=str, default=metrics_file,
+                        help='Record the timing of every API call in this'
+                             ' file (.prom for Prometheus text format,'
+                             ' JSON lines otherwise)')
+    args = parser.parse_args()
 
-    pyrax.set_setting("identity_type", "rackspace")
-    pyrax.set_credential_file(credentials)
-    clb = pyrax.cloud_loadbalancers
+    if args.metrics_file:
+        timing.install(args.metrics_file)
+    timer = PhaseTimer()
+    api = get_api(timer)
     my_ip = get_addr(iface)
 
+    if not lbs:
+        return
+
+    # Health checks and additions for all load balancers run side by side,
+    # so the node is in service as soon as the slowest LB accepts it
+    pool = ThreadPool(len(lbs))
+    try:
+        with timer.phase('register'):
+            results = pool.map(lambda lb_id: register(api, lb_id, my_ip),
+                               lbs)
+    finally:
+        pool.close()
+        pool.join()
 
+    for result in results:
+        if result.status == Registration.ADDED:
+            print ("Node added to LB %s" % result.lb_id)
+        elif result.status == Registration.PRESENT:
+            print ("Node %s already in LB %s.." % (result.message, result.lb_id))
+        elif result.status == Registration.QUEUED:
+            print ("Node reported ready for LB %s to coordinator" % result.lb_id)
+        elif result.status == Registration.UNHEALTHY:
+            print("Health check for LB %s failed with error: %s  Not adding..." % (result.lb_id, result.message))
+        else:
+            print ("Failed to add node to LB %s: %s" % (result.lb_id, result.message))
 
-    for lb_id in lbs:
-        retry = 5
-        lb=clb.get(lb_id)
+    # Only a fresh addition says how long it took to go into service
+    if readiness_url and all(r.status == Registration.ADDED for r in results):
         try:
-            health_check(lb.get_health_monitor(), lb.port)
+            report_readiness(my_ip, results)
         except Exception as e:
-            print("Health check for LB %s failed with error: %s  Not adding..." % (lb_id, str(e)))
-            continue
-
-        while retry > 0:
-            try:
-                pyrax.utils.wait_until(lb, "status", "ACTIVE", interval=1, attempts=30, verbose=False)
-                node = clb.Node(address = my_ip, port = lb.port, condition = "ENABLED")
-                res = lb.add_nodes([node])
-                print ("Node added to LB %s" % lb_id)
-                break
-            except pyrax.exceptions.ClientException as e:
-                if "PENDING" in e.message:
-                    print ("Race condition hit, another server is adding itself. Retrying...")
-                    sleep(random.random())
-                if "Duplicate nodes" in e.message:
-                    print ("Node %s:%s already in LB %s.." % (my_ip, lb.port, lb_id))
-                    break
-                else:
-                    print ("Exception: %s" % e.message)
-                    break
-            retry -= 1
+            print("Unable to report readiness: %s" % e)
+
+    if args.profile_startup:
+        timer.report(api)
 
 
 if __name__ == "__main__":
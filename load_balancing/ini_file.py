@@ -0,0 +1,106 @@
+"""
+Changes keys in an ini file such as config.ini in place.
+
+main.py (through utils.config.flush()) and readiness.py --update-config
+both change keys in the same config file, possibly at the same time. update()
+locks out other writers while it re-reads the file and applies the changes to
+it, and replaces the file atomically, so it is never left half written or
+with one of the writers' changes lost. Only the lines of the keys that change
+are rewritten, so comments and the layout of the rest of the file are kept.
+
+License: Apache License Version 2.0 http://www.apache.org/licenses/LICENSE-2.0
+"""
+
+import os
+import re
+import stat
+import fcntl
+import tempfile
+
+SECTION = re.compile(r'^\[(?P<name>[^\]]+)\]')
+OPTION = re.compile(r'^(?P<key>[^:=\s;#][^:=]*?)\s*[:=]')
+
+
+def apply_changes(lines, changes):
+    """ Returns lines with the values in changes, a dict of
+        (section, key) -> value, set. Keys that aren't there yet are added
+        at the end of their section, and sections at the end of the file
+    """
+    changes = dict(((section, key.lower()), value)
+                   for (section, key), value in changes.iteritems())
+    result = []
+    # Index in result after the last key of each section seen
+    section_end = {}
+    section = None
+    in_changed = False
+    for line in lines:
+        # Continuation lines belong to the key above them
+        if in_changed and line[:1] in (' ', '\t') and line.strip():
+            continue
+        in_changed = False
+        match = SECTION.match(line)
+        if match:
+            section = match.group('name').strip()
+            result.append(line)
+            section_end[section] = len(result)
+            continue
+        match = OPTION.match(line)
+        if match and section is not None:
+            key = match.group('key').strip().lower()
+            if (section, key) in changes:
+                line = '%s = %s\n' % (match.group('key').strip(),
+                                      changes.pop((section, key)))
+                in_changed = True
+            result.append(line)
+            section_end[section] = len(result)
+            continue
+        result.append(line)
+
+    for (section, key), value in sorted(changes.iteritems()):
+        if section in section_end:
+            index = section_end[section]
+            result.insert(index, '%s = %s\n' % (key, value))
+            for name, end in section_end.iteritems():
+                if end >= index:
+                    section_end[name] = end + 1
+            continue
+        if result and not result[-1].endswith('\n'):
+            result[-1] += '\n'
+        if result and result[-1].strip():
+            result.append('\n')
+        result.append('[%s]\n' % section)
+        result.append('%s = %s\n' % (key, value))
+        section_end[section] = len(result)
+    return result
+
+
+def update(file_name, changes):
+    """ Sets the values in changes, a dict of (section, key) -> value, in
+        file_name
+    """
+    file_dir = os.path.dirname(os.path.abspath(file_name))
+    with open(file_name + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            try:
+                with open(file_name, 'r') as fp:
+                    lines = fp.readlines()
+            except IOError:
+                lines = []
+            lines = apply_changes(lines, changes)
+            fd, tmp_file = tempfile.mkstemp(
+                dir=file_dir, prefix='.%s.' % os.path.basename(file_name))
+            try:
+                with os.fdopen(fd, 'w') as fp:
+                    fp.writelines(lines)
+                    fp.flush()
+                    os.fsync(fp.fileno())
+                if os.path.exists(file_name):
+                    os.chmod(tmp_file, stat.S_IMODE(
+                        os.stat(file_name).st_mode))
+                os.rename(tmp_file, file_name)
+            except Exception:
+                os.remove(tmp_file)
+                raise
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
@@ -0,0 +1,310 @@
+"""
+Lightweight stand-in for the parts of pyrax used by the load balancing
+scripts.
+
+Importing pyrax pulls in novaclient, keystoneclient and their dependencies,
+which takes up most of the run time of a cron job on a small server. This
+module talks to the handful of API endpoints the scripts need directly, and
+hands out objects with the same attributes and methods as their pyrax
+counterparts, so the scripts work unchanged with either:
+
+ - autoscale.get(group_id).get_state()
+ - cloudservers.servers.list(marker, limit) / .get(server_id)
+ - cloud_loadbalancers.get(lb_id), its nodes, add_nodes() and
+   get_health_monitor(), and cloud_loadbalancers.Node()
+
+Tokens are shared with pyrax through token_cache.
+
+License: Apache License Version 2.0 http://www.apache.org/licenses/LICENSE-2.0
+"""
+
+import json
+import time
+import ConfigParser
+import requests
+import token_cache
+
+IDENTITY_URL = 'https://identity.api.rackspacecloud.com/v2.0/tokens'
+
+# Timeout in seconds (connect, read) for API requests
+HTTP_TIMEOUT = (10, 30)
+
+
+class ClientException(Exception):
+    """ Raised for error responses, with the same code and message
+        attributes as pyrax.exceptions.ClientException
+    """
+
+    def __init__(self, code, message=None):
+        self.code = code
+        self.message = message or "HTTP %s" % code
+        super(ClientException, self).__init__(self.message)
+
+
+class NotFound(ClientException):
+    pass
+
+
+class Exceptions(object):
+    """ Mirrors the pyrax.exceptions module """
+    ClientException = ClientException
+    NotFound = NotFound
+
+
+class Client(object):
+    """ Authenticated API client. Keeps one HTTP session for all requests,
+        and counts the requests made and the time spent on them
+    """
+
+    def __init__(self, username, api_key, region=None,
+                 cache_dir=token_cache.DEFAULT_CACHE_DIR):
+        self.username = username
+        self.api_key = api_key
+        self.cache_file = token_cache.get_cache_file(cache_dir, username)
+        self.session = requests.Session()
+        self.api_calls = 0
+        self.api_time = 0.0
+        self.access = None
+        self.authenticate(use_cache=True)
+        self.region = region or self.access['access']['user'].get(
+            'RAX-AUTH:defaultRegion')
+
+    def authenticate(self, use_cache=False):
+        access = token_cache.read_cache(self.cache_file) if use_cache \
+            else None
+        if access is None:
+            body = {'auth': {'RAX-KSKEY:apiKeyCredentials': {
+                'username': self.username, 'apiKey': self.api_key}}}
+            started = time.time()
+            resp = self.session.post(IDENTITY_URL, data=json.dumps(body),
+                                     headers={'Content-Type':
+                                              'application/json'},
+                                     timeout=HTTP_TIMEOUT)
+            self.api_calls += 1
+            self.api_time += time.time() - started
+            if resp.status_code != 200:
+                raise ClientException(resp.status_code,
+                                      "Authentication failed: %s" % resp.text)
+            access = resp.json()
+            token_cache.write_cache(self.cache_file, access)
+        self.access = access
+
+    def get_endpoint(self, service_type):
+        for service in self.access['access']['serviceCatalog']:
+            if service.get('type') != service_type:
+                continue
+            for endpoint in service.get('endpoints', []):
+                if endpoint.get('region', '').upper() == self.region.upper():
+                    return endpoint['publicURL']
+        raise ClientException(None, "No %s endpoint in region %s" % (
+            service_type, self.region))
+
+    def request(self, method, service_type, path, body=None, retry_auth=True):
+        """ Makes an API request, re-authenticating once if the token is
+            rejected. Returns the decoded response body, if any
+        """
+        url = self.get_endpoint(service_type) + path
+        headers = {'X-Auth-Token': self.access['access']['token']['id'],
+                   'Content-Type': 'application/json',
+                   'Accept': 'application/json'}
+        started = time.time()
+        resp = self.session.request(method, url, headers=headers,
+                                    data=json.dumps(body) if body else None,
+                                    timeout=HTTP_TIMEOUT)
+        self.api_calls += 1
+        self.api_time += time.time() - started
+
+        if resp.status_code == 401 and retry_auth:
+            self.authenticate()
+            return self.request(method, service_type, path, body,
+                                retry_auth=False)
+        if resp.status_code >= 400:
+            try:
+                error = resp.json()
+                # Errors are either {"message": ..} or {"someError": {"message": ..}}
+                if 'message' not in error and len(error) == 1:
+                    error = error.values()[0]
+                message = error.get('message') or error.get('details')
+            except (ValueError, AttributeError):
+                message = resp.text
+            cls = NotFound if resp.status_code == 404 else ClientException
+            raise cls(resp.status_code, message)
+        if resp.content:
+            return resp.json()
+        return None
+
+
+class ScalingGroup(object):
+
+    def __init__(self, client, group_id):
+        self.client = client
+        self.id = group_id
+
+    def get_state(self):
+        """ Same format as pyrax's ScalingGroup.get_state() """
+        group = self.client.request('GET', 'rax:autoscale',
+                                    '/groups/%s/state' % self.id)['group']
+        return {'active': [server['id'] for server in group['active']],
+                'active_capacity': group['activeCapacity'],
+                'desired_capacity': group['desiredCapacity'],
+                'pending_capacity': group['pendingCapacity'],
+                'paused': group.get('paused')}
+
+
+class Autoscale(object):
+
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, group_id):
+        # The group is only needed for its state, which is fetched on demand
+        return ScalingGroup(self.client, group_id)
+
+
+class Server(object):
+
+    def __init__(self, info):
+        self.id = info['id']
+        self.name = info.get('name')
+        self.status = info.get('status')
+        self.created = info.get('created')
+        # Same format as novaclient's Server.networks
+        self.networks = {}
+        for network, addresses in info.get('addresses', {}).iteritems():
+            self.networks[network] = [a['addr'] for a in addresses]
+
+
+class ServerManager(object):
+
+    def __init__(self, client):
+        self.client = client
+
+    def list(self, marker=None, limit=None):
+        path = '/servers/detail'
+        params = []
+        if marker:
+            params.append('marker=%s' % marker)
+        if limit:
+            params.append('limit=%s' % limit)
+        if params:
+            path += '?' + '&'.join(params)
+        return [Server(info) for info in
+                self.client.request('GET', 'compute', path)['servers']]
+
+    def get(self, server_id):
+        return Server(self.client.request('GET', 'compute',
+                                          '/servers/%s' % server_id)['server'])
+
+
+class CloudServers(object):
+
+    def __init__(self, client):
+        self.servers = ServerManager(client)
+
+
+class Node(object):
+
+    def __init__(self, address=None, port=None, condition=None, lb=None,
+                 info=None):
+        self.lb = lb
+        self.address = address
+        self.port = port
+        self.condition = condition
+        self.id = None
+        self.status = None
+        if info:
+            self.id = info.get('id')
+            self.address = info.get('address')
+            self.port = info.get('port')
+            self.condition = info.get('condition')
+            self.status = info.get('status')
+
+    def to_dict(self):
+        return {'address': self.address, 'port': self.port,
+                'condition': self.condition}
+
+    def update(self):
+        """ Sends the node's condition to the load balancer """
+        self.lb.client.request('PUT', 'rax:load-balancer',
+                               '/loadbalancers/%s/nodes/%s' % (
+                                   self.lb.id, self.id),
+                               {'node': {'condition': self.condition}})
+
+    def delete(self):
+        self.lb.client.request('DELETE', 'rax:load-balancer',
+                               '/loadbalancers/%s/nodes/%s' % (
+                                   self.lb.id, self.id))
+
+
+class LoadBalancer(object):
+
+    def __init__(self, client, lb_id):
+        self.client = client
+        self.id = lb_id
+        self.get()
+
+    def get(self):
+        """ Reloads the load balancer """
+        info = self.client.request('GET', 'rax:load-balancer',
+                                   '/loadbalancers/%s' % self.id)
+        info = info['loadBalancer']
+        self.name = info.get('name')
+        self.port = info.get('port')
+        self.status = info.get('status')
+        # Like pyrax, only set nodes if there are any
+        if info.get('nodes'):
+            self.nodes = [Node(lb=self, info=n) for n in info['nodes']]
+        elif hasattr(self, 'nodes'):
+            del self.nodes
+
+    def get_health_monitor(self):
+        return self.client.request('GET', 'rax:load-balancer',
+                                   '/loadbalancers/%s/healthmonitor' %
+                                   self.id).get('healthMonitor', {})
+
+    def get_stats(self):
+        return self.client.request('GET', 'rax:load-balancer',
+                                   '/loadbalancers/%s/stats' % self.id)
+
+    def add_nodes(self, nodes):
+        return self.client.request('POST', 'rax:load-balancer',
+                                   '/loadbalancers/%s/nodes' % self.id,
+                                   {'nodes': [n.to_dict() for n in nodes]})
+
+
+class CloudLoadBalancers(object):
+
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, lb_id):
+        return LoadBalancer(self.client, lb_id)
+
+    def Node(self, address=None, port=None, condition=None):
+        return Node(address=address, port=port, condition=condition)
+
+
+class Api(object):
+    """ Mirrors the subset of the pyrax module the scripts use """
+    exceptions = Exceptions
+
+    def __init__(self, client):
+        self.client = client
+        self.autoscale = Autoscale(client)
+        self.cloudservers = CloudServers(client)
+        self.cloud_loadbalancers = CloudLoadBalancers(client)
+
+
+def connect(credential_file, region=None):
+    """ Reads a pyrax credentials file, authenticates and returns an Api """
+    cfg = ConfigParser.SafeConfigParser()
+    if not cfg.read(credential_file):
+        raise Exception("Unable to read credentials file %s" %
+                        credential_file)
+    section = 'rackspace_cloud' if cfg.has_section('rackspace_cloud') \
+        else 'keystone'
+    username = cfg.get(section, 'username').strip("'\"")
+    api_key = cfg.get(section, 'api_key').strip("'\"")
+    if not region and cfg.has_option(section, 'region'):
+        region = cfg.get(section, 'region').strip("'\"")
+    return Api(Client(username, api_key, region))
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+
+###################################################################################
+#                                                                                 #
+# This script runs on the admin server next to remove_dead_nodes.py, and adds     #
+# nodes to the load balancer(s) on behalf of add_self_to_lb.py.                   #
+#                                                                                 #
+# A load balancer goes into PENDING_UPDATE for every change made to it, so when   #
+# many servers are scaled up at once and each adds itself, they end up queueing   #
+# behind each other's updates. When add_self_to_lb.py has coordinator_url set,    #
+# servers that pass the health check instead report here, and every server that   #
+# became ready within batch_window seconds is added in one add_nodes() call per   #
+# load balancer.                                                                  #
+#                                                                                 #
+# Servers report by POSTing {"lb_id": 1234, "address": "10.0.0.1"} to             #
+# http://<listen_address>:<listen_port>/nodes with auth_token in an               #
+# X-Auth-Token header, or by creating an empty file named <lb_id>_<address> in    #
+# spool_dir (e.g. over ssh as the autoscale user).                                #
+#                                                                                 #
+# If the load balancer rejects a batch, the nodes are added in smaller batches to #
+# find the address(es) it won't accept, which are dropped. Nodes that couldn't be #
+# added because of a temporary error go out with the next batch, up to            #
+# max_attempts times.                                                             #
+#                                                                                 #
+# License: Apache License Version 2.0 http://www.apache.org/licenses/LICENSE-2.0  #
+###################################################################################
+
+from __future__ import print_function
+
+import os
+import sys
+import hmac
+import json
+import time
+import socket
+import pyrax
+import logging
+import threading
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from multiprocessing.pool import ThreadPool
+from retry_policy import RetryPolicy
+import token_cache
+
+####################### CONFIGURATION #######################
+
+# LOAD BALANCER(S) servers may ask to be added to (REQUIRED)
+# e.g. lbs = [254784, 854574]
+# (list)
+lbs = []
+
+# Path where customer's credentials are stored (REQUIRED)
+# e.g. credentials = '/opt/autoscale/.cloud_credentials'
+# (string)
+credentials = ''
+
+# Address and port to accept readiness reports on. Set listen_address to the
+# admin server's ServiceNet (or other private network) address for the
+# autoscaled servers to be able to reach it, and make sure only they can.
+# e.g. listen_address = '10.180.1.2'
+# (string, int)
+listen_address = '127.0.0.1'
+listen_port = 8910
+
+# Shared secret servers must send in the X-Auth-Token header of their reports,
+# set the same as coordinator_token in add_self_to_lb.py (REQUIRED)
+# (string)
+auth_token = ''
+
+# Directory to pick up readiness files from, None to disable
+# e.g. spool_dir = '/home/autoscale/ready'
+# (string)
+spool_dir = None
+
+# Seconds to wait after the first server in a batch reported ready, to give
+# others booting at the same time a chance to join the same batch
+# (int)
+batch_window = 5
+
+# Seconds to keep retrying while the load balancer is busy with other updates
+# (int)
+retry_deadline = 120
+
+# Number of batches to try a node in before giving up on it, when it can't be
+# added because of temporary errors
+# (int)
+max_attempts = 5
+
+# Log file name
+# e.g log_file = '/opt/autoscale/node_coordinator.log'
+# (string)
+log_file = None
+
+######################################################################
+
+
+log_root = logging.getLogger()
+logging.basicConfig(filename=log_file, level=logging.INFO)
+logging.getLogger("urllib3").setLevel(logging.WARNING)
+if log_file:
+    console_log = logging.StreamHandler(sys.stdout)
+    console_log.setLevel(logging.DEBUG)
+    log_root.addHandler(console_log)
+
+
+def is_ip_address(address):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, address)
+            return True
+        except (socket.error, ValueError):
+            pass
+    return False
+
+
+class PendingNodes(object):
+    """ Addresses waiting to be added, per load balancer """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.nodes = {}
+        self.first_added = None
+        # Batches each (lb_id, address) has been part of without being added
+        self.attempts = {}
+
+    def add(self, lb_id, address):
+        """ Queues an address for a load balancer. Returns False if either
+            isn't acceptable
+        """
+        if lb_id not in lbs or not is_ip_address(address):
+            return False
+        with self.lock:
+            self.nodes.setdefault(lb_id, set()).add(address)
+            if self.first_added is None:
+                self.first_added = time.time()
+        return True
+
+    def retry(self, lb_id, address):
+        """ Queues an address that couldn't be added again, unless it has
+            been tried max_attempts times already
+        """
+        with self.lock:
+            attempts = self.attempts.get((lb_id, address), 0) + 1
+            if attempts >= max_attempts:
+                self.attempts.pop((lb_id, address), None)
+                log_root.error("Giving up on adding %s to loadbalancer %s"
+                               " after %d attempts" % (address, lb_id,
+                                                       attempts))
+                return False
+            self.attempts[(lb_id, address)] = attempts
+        return self.add(lb_id, address)
+
+    def forget(self, lb_id, address):
+        with self.lock:
+            self.attempts.pop((lb_id, address), None)
+
+    def take_batch(self, window):
+        """ Returns and forgets everything queued, once the oldest entry has
+            waited window seconds. Returns an empty dict until then
+        """
+        with self.lock:
+            if self.first_added is None or \
+               time.time() - self.first_added < window:
+                return {}
+            batch = self.nodes
+            self.nodes = {}
+            self.first_added = None
+        return batch
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ReadinessHandler(BaseHTTPRequestHandler):
+    pending = None
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/nodes':
+            self.send_error(404)
+            return
+        token = self.headers.getheader('x-auth-token') or ''
+        if not hmac.compare_digest(token, auth_token):
+            self.send_error(401, "Missing or wrong X-Auth-Token")
+            return
+        try:
+            length = int(self.headers.getheader('content-length') or 0)
+            body = json.loads(self.rfile.read(length))
+            lb_id = int(body.get('lb_id'))
+            address = str(body.get('address'))
+        except (ValueError, TypeError, AttributeError):
+            self.send_error(400, "Expected {\"lb_id\": ..., \"address\": ...}")
+            return
+        if not self.pending.add(lb_id, address):
+            self.send_error(403, "Unknown load balancer or invalid address")
+            return
+        log_root.info("%s ready to be added to loadbalancer %s" % (
+            address, lb_id))
+        self.send_response(202)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        log_root.debug(format % args)
+
+
+def read_spool(pending):
+    """ Queues the servers that reported ready by dropping a file """
+    for file_name in os.listdir(spool_dir):
+        try:
+            lb_id, address = file_name.split('_', 1)
+            if pending.add(int(lb_id), address):
+                log_root.info("%s ready to be added to loadbalancer %s" % (
+                    address, lb_id))
+            else:
+                log_root.warning("Ignoring readiness file %s" % file_name)
+        except ValueError:
+            log_root.warning("Ignoring readiness file %s" % file_name)
+        os.remove(os.path.join(spool_dir, file_name))
+
+
+def is_rejected(exc, policy):
+    """ Whether the load balancer refused the nodes themselves, rather than
+        the request failing for a temporary reason
+    """
+    code = getattr(exc, 'code', None)
+    return code is not None and 400 <= code < 500 and \
+        not policy.is_retryable(exc)
+
+
+def add_nodes(clb, lb, addresses, policy):
+    """ Adds addresses in a single add_nodes() call. If the load balancer
+        rejects them, they are split in two and each half added separately,
+        until the addresses it won't accept are found. Returns the set of
+        addresses it rejected, and raises any other error
+    """
+    def add():
+        policy.wait_until(lb, "status", "ACTIVE")
+        lb.add_nodes([clb.Node(address=address, port=lb.port,
+                               condition="ENABLED") for address in addresses])
+
+    try:
+        policy.call(add)
+        log_root.info("Added %s to loadbalancer %s" % (
+            ', '.join(addresses), lb.id))
+        return set()
+    except Exception as ex:
+        if not is_rejected(ex, policy):
+            raise
+        if "Duplicate nodes" in str(getattr(ex, 'message', None) or ex):
+            # Already added, e.g. by hand
+            if len(addresses) == 1:
+                return set()
+        elif len(addresses) == 1:
+            log_root.error("Loadbalancer %s rejected %s, dropping it: %s" % (
+                lb.id, addresses[0], ex))
+            return set(addresses)
+    middle = len(addresses) // 2
+    return add_nodes(clb, lb, addresses[:middle], policy) | \
+        add_nodes(clb, lb, addresses[middle:], policy)
+
+
+def add_batch(clb, lb_id, addresses):
+    """ Adds all addresses not already in the load balancer, in as few
+        add_nodes() calls as possible. Returns the addresses that could not
+        be added for a temporary reason, and are worth trying again
+    """
+    policy = RetryPolicy(deadline=retry_deadline)
+    done = set()
+    try:
+        lb = clb.get(lb_id)
+        try:
+            existing = set(node.address for node in lb.nodes)
+        except AttributeError:
+            # This is thrown when there are no nodes under an LB
+            existing = set()
+        done = addresses & existing
+        new = sorted(addresses - existing)
+        if new:
+            add_nodes(clb, lb, new, policy)
+        return set()
+    except Exception as ex:
+        log_root.error("Failed to add %s to loadbalancer %s: %s" % (
+            ', '.join(sorted(addresses - done)), lb_id, ex))
+        # Whatever went in before the error is picked up as existing next
+        # time round
+        return addresses - done
+
+
+def main():
+    if not auth_token:
+        raise Exception("Please set auth_token")
+    pyrax.set_setting("identity_type", "rackspace")
+    token_cache.authenticate(pyrax, credential_file=credentials)
+    clb = pyrax.cloud_loadbalancers
+
+    pending = PendingNodes()
+    ReadinessHandler.pending = pending
+    server = ThreadingHTTPServer((listen_address, listen_port),
+                                 ReadinessHandler)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    log_root.info("Accepting readiness reports on %s:%s" % (
+        listen_address, listen_port))
+
+    pool = ThreadPool(max(1, len(lbs)))
+    while True:
+        if spool_dir:
+            read_spool(pending)
+        batch = pending.take_batch(batch_window)
+        if batch:
+            lb_ids = batch.keys()
+            failed = pool.map(
+                lambda lb_id: add_batch(clb, lb_id, batch[lb_id]), lb_ids)
+            # Put back what failed, it will go out with the next batch
+            for lb_id, addresses in zip(lb_ids, failed):
+                for address in batch[lb_id] - addresses:
+                    pending.forget(lb_id, address)
+                for address in addresses:
+                    pending.retry(lb_id, address)
+        time.sleep(0.5)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+###################################################################################
+#                                                                                 #
+# Measures how long it takes a scaled up server to go into service, and derives   #
+# the settings that depend on it.                                                 #
+#                                                                                 #
+# When readiness_url is set, add_self_to_lb.py reports when the server booted,    #
+# when it passed the health check and when it was added to the load balancer(s).  #
+# remove_dead_nodes.py --listen stores these reports in readiness_file, along     #
+# with when the server was created (i.e. when the scale up started building it),  #
+# which it knows from the group's servers.                                        #
+#                                                                                 #
+# Running this script prints percentiles for each stage and, from the p95 of the  #
+# time to go into service:                                                        #
+#  - MAX_FAILURES for monitoring/wrapper.py, as described in its header           #
+#  - the cooldown for the scaling policies, so another scale up isn't started     #
+#    before the servers from the last one can take load                           #
+# These are also written to summary_file, which wrapper.py reads if its           #
+# READINESS_FILE is set, and --update-config writes the cooldown to config.ini.   #
+#                                                                                 #
+# License: Apache License Version 2.0 http://www.apache.org/licenses/LICENSE-2.0  #
+###################################################################################
+
+from __future__ import print_function
+
+import os
+import json
+import math
+import time
+import calendar
+import argparse
+import threading
+
+####################### CONFIGURATION #######################
+
+# File the reports from add_self_to_lb.py are stored in
+# (string)
+readiness_file = '/var/tmp/readiness.json'
+
+# Number of most recent reports to keep
+# (int)
+max_records = 500
+
+# File to write the percentiles and derived settings to
+# (string)
+summary_file = '/var/tmp/readiness.summary.json'
+
+# Seconds between runs of rax-autoscaler (from its cron entry). Can be
+# overridden with --cron-interval
+# (int)
+cron_interval = 120
+
+######################################################################
+
+# Each stage is measured from the first timestamp to the second
+STAGES = (('boot_to_healthy', 'booted', 'healthy'),
+          ('healthy_to_in_service', 'healthy', 'in_service'),
+          ('boot_to_in_service', 'booted', 'in_service'),
+          ('created_to_in_service', 'created', 'in_service'))
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def parse_created(created):
+    """ Converts a server's 'created' attribute (e.g. 2014-05-12T10:20:30Z)
+        to a unix timestamp
+    """
+    return calendar.timegm(time.strptime(created[:19], '%Y-%m-%dT%H:%M:%S'))
+
+
+class ReadinessLog(object):
+    """ The most recent readiness reports, persisted in readiness_file """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.file_name, 'r') as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return []
+
+    def save(self, records):
+        tmp_file = '%s.%d.tmp' % (self.file_name, os.getpid())
+        with open(tmp_file, 'w') as fp:
+            json.dump(records[-max_records:], fp)
+        os.rename(tmp_file, self.file_name)
+
+    def add(self, record):
+        """ Stores a report from add_self_to_lb.py """
+        record = dict((key, record.get(key)) for key in
+                      ('address', 'booted', 'healthy', 'in_service'))
+        record['reported'] = time.time()
+        record['created'] = None
+        with self.lock:
+            records = self.load()
+            records.append(record)
+            self.save(records)
+
+    def fill_created(self, get_created):
+        """ Adds the creation time of the server to reports that don't have
+            it yet. get_created returns it for an address, or None if that
+            isn't known (yet)
+        """
+        with self.lock:
+            records = self.load()
+            changed = False
+            for record in records:
+                if record.get('created') is None:
+                    record['created'] = get_created(record['address'])
+                    changed = changed or record['created'] is not None
+            if changed:
+                self.save(records)
+
+
+def percentile(values, p):
+    """ Returns the p-th percentile of values, interpolating between the
+        closest ranks
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    rank = (len(values) - 1) * p / 100.0
+    low = int(math.floor(rank))
+    high = int(math.ceil(rank))
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def summarize(records):
+    """ Returns the number of samples and the percentiles of each stage """
+    stages = {}
+    for name, start, end in STAGES:
+        durations = [r[end] - r[start] for r in records
+                     if r.get(start) is not None and r.get(end) is not None]
+        stages[name] = {'count': len(durations)}
+        for p in PERCENTILES:
+            stages[name]['p%d' % p] = percentile(durations, p)
+    return stages
+
+
+def derive_settings(stages, cron_interval):
+    """ Returns the wrapper's MAX_FAILURES and the policy cooldown, from the
+        p95 of the time from the server being created (or, when that isn't
+        known, booted) until it is in service
+    """
+    p95 = stages['created_to_in_service']['p95']
+    if p95 is None:
+        p95 = stages['boot_to_in_service']['p95']
+    if p95 is None:
+        return None
+    # ((av_time_new_server_ready / rax-autoscaler_cron_time)) x2
+    return {'based_on_p95': p95,
+            'max_failures': int(math.ceil(p95 / cron_interval)) * 2,
+            'cooldown': int(math.ceil(p95))}
+
+
+def update_config(config_file, cooldown):
+    """ Sets the cooldown in config_file the same way main.py writes it, so
+        neither overwrites the other's changes
+    """
+    # Only needed here, so remove_dead_nodes.py can import this without it
+    import ini_file
+    if not os.path.isfile(config_file):
+        raise Exception("Unable to read config file %s" % config_file)
+    ini_file.update(config_file, {('autoscale', 'cooldown'): cooldown})
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        'Report how long new servers take to go into service')
+    parser.add_argument('--cron-interval', type=int, default=cron_interval,
+                        help='Seconds between runs of rax-autoscaler'
+                             ' (default %d)' % cron_interval)
+    parser.add_argument('--update-config', type=str, default=None,
+                        metavar='CONFIG_FILE',
+                        help='Set the derived cooldown in the [autoscale]'
+                             ' section of this config file (apply it with'
+                             ' main.py afterwards)')
+    args = parser.parse_args()
+
+    records = ReadinessLog(readiness_file).load()
+    stages = summarize(records)
+    print("%-24s %6s %8s %8s %8s %8s" % (('stage', 'count') + tuple(
+        'p%d' % p for p in PERCENTILES)))
+    for name, start, end in STAGES:
+        print("%-24s %6d" % (name, stages[name]['count']), end='')
+        for p in PERCENTILES:
+            value = stages[name]['p%d' % p]
+            print(" %7.1fs" % value if value is not None else " %8s" % '-',
+                  end='')
+        print()
+
+    settings = derive_settings(stages, args.cron_interval)
+    summary = {'time': time.time(), 'stages': stages, 'settings': settings}
+    tmp_file = '%s.%d.tmp' % (summary_file, os.getpid())
+    with open(tmp_file, 'w') as fp:
+        json.dump(summary, fp)
+    os.rename(tmp_file, summary_file)
+
+    if settings is None:
+        print("\nNo servers have reported going into service yet")
+        return
+    print("\nBased on a p95 of %.1fs to go into service:" %
+          settings['based_on_p95'])
+    print(" MAX_FAILURES = %d (for a %ds cron interval)" % (
+        settings['max_failures'], args.cron_interval))
+    print(" cooldown = %d" % settings['cooldown'])
+    if args.update_config:
+        update_config(args.update_config, settings['cooldown'])
+        print("Updated cooldown in %s" % args.update_config)
+
+
+if __name__ == '__main__':
+    main()
@@ -17,9 +17,21 @@
 
 from __future__ import print_function
 
+import os
 import sys
-import pyrax
+import json
+import time
 import logging
+import argparse
+import threading
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from multiprocessing.pool import ThreadPool
+from retry_policy import RetryPolicy
+import timing
+from timing import PhaseTimer
+import token_cache
+import readiness
 
 ####################### CONFIGURATION #######################
 
@@ -65,6 +77,64 @@ log_file = None
 # (bool)
 delete_online = False
 
+# Number of servers requested per page when listing the servers in the
+# account, and number of concurrent lookups for any group member not found
+# in the listing
+# (int)
+page_size = 500
+max_workers = 8
+
+# Seconds to let a node drain connections before deleting it. Nodes the
+# load balancer reports as OFFLINE can't have any connections, and are
+# deleted without waiting, as are all draining nodes once the load balancer
+# reports no current connections at all. When the first drain in a run expires within this
+# time, the run waits for it rather than leaving it to the next run.
+# (int)
+drain_timeout = 30
+
+# File recording when each node started draining
+# (string)
+drain_state_file = '/var/tmp/remove_dead_nodes.drain.json'
+
+# File to write the state of the group and load balancer(s) to after every
+# run, for monitoring/fail_file_monitor.py to report on without making API
+# calls of its own. None to disable
+# (string)
+status_file = '/var/tmp/remove_dead_nodes.status.json'
+
+# Seconds between reconciliations when running with --daemon
+# (int)
+daemon_interval = 60
+
+# Address and port to listen on with --listen. Any request to it triggers a
+# reconciliation, e.g. from a rax-autoscaler 'post' webhook (see
+# reconcile_url in config.ini.sample). Requests arriving within
+# listen_debounce seconds of each other are handled by one reconciliation.
+# Reports POSTed to /readiness by add_self_to_lb.py (see its readiness_url)
+# are stored for readiness.py instead; for those, listen on an address the
+# autoscaled servers can reach.
+# (string, int, int)
+listen_address = '127.0.0.1'
+listen_port = 8911
+listen_debounce = 5
+
+# Seconds to keep retrying a node change while the load balancer is busy
+# with other updates
+# (int)
+retry_deadline = 120
+
+# Talk to the API through the bundled light_client.py rather than pyrax,
+# which is much quicker to import
+# (bool)
+lightweight_client = False
+
+# File to record the duration, status and retries of every API call in.
+# Written in the Prometheus text format if the name ends in .prom, and as
+# JSON lines otherwise. Can be overridden with --metrics-file
+# e.g. metrics_file = '/var/lib/node_exporter/remove_dead_nodes.prom'
+# (string)
+metrics_file = None
+
 ######################################################################
 
 
@@ -77,50 +147,478 @@ if log_file:
     log_root.addHandler(console_log)
 
 
-def main():
-    pyrax.set_setting("identity_type", "rackspace")
-    pyrax.set_credential_file(credentials)
-    clb = pyrax.cloud_loadbalancers
-    csrv = pyrax.cloudservers
-    asg = pyrax.autoscale.get(as_group)
+def get_server_addresses(server):
+    addresses = set()
+    for network in server.networks:
+        addresses.update(server.networks.get(network))
+    return addresses
+
+
+def get_server(csrv, server_id):
+    """ Returns the server, or None if it has been deleted in the meantime """
+    try:
+        return csrv.servers.get(server_id)
+    except Exception as ex:
+        # NotFound, from novaclient or light_client, which both set the code
+        if getattr(ex, 'code', None) == 404:
+            return None
+        raise
+
+
+def get_group_servers(csrv, server_ids):
+    """ Returns a dict mapping each of the given server IDs to its server.
+        The account's servers are listed a page at a time until all of them
+        have been seen, which costs far fewer round trips than one lookup per
+        server. Any server not found that way is fetched individually on a
+        bounded thread pool, and left out if it no longer exists.
+    """
+    missing = set(server_ids)
+    found = {}
+    marker = None
+    while missing:
+        servers = csrv.servers.list(marker=marker, limit=page_size)
+        for server in servers:
+            if server.id in missing:
+                missing.discard(server.id)
+                found[server.id] = server
+        if len(servers) < page_size:
+            break
+        marker = servers[-1].id
+
+    if missing:
+        pool = ThreadPool(min(max_workers, len(missing)))
+        try:
+            for server in pool.map(lambda server_id: get_server(
+                    csrv, server_id), missing):
+                if server is not None:
+                    found[server.id] = server
+        finally:
+            pool.close()
+            pool.join()
+    return found
 
-    # Pretend that all whitelisted servers are in the group
-    addresses_in_grp = whitelist if whitelist else []
 
-    for server_id in asg.get_state().get('active'):
-        server = csrv.servers.get(server_id)
-        for network in server.networks:
-            for address in server.networks.get(network):
-                addresses_in_grp.append(address)
+def get_group_addresses(csrv, server_ids):
+    """ Returns a dict mapping each of the given server IDs to the set of its
+        IP addresses
+    """
+    return dict((server_id, get_server_addresses(server)) for server_id, server
+                in get_group_servers(csrv, server_ids).iteritems())
 
-    for id in lbs:
-        lb = clb.get(id)
+
+class AddressCache(object):
+    """ Remembers the addresses of the group's servers between runs. A
+        server's addresses never change, so only servers that have become
+        active since the last update are looked up.
+    """
+
+    def __init__(self, csrv):
+        self.csrv = csrv
+        self.addresses = {}
+        # When each server was created, by address
+        self.created = {}
+
+    def update(self, server_ids):
+        """ Returns the set of addresses of the given (active) servers """
+        server_ids = set(server_ids)
+        for server_id in set(self.addresses) - server_ids:
+            for address in self.addresses.pop(server_id):
+                self.created.pop(address, None)
+        new_ids = server_ids - set(self.addresses)
+        if new_ids:
+            for server_id, server in get_group_servers(
+                    self.csrv, new_ids).iteritems():
+                self.addresses[server_id] = get_server_addresses(server)
+                if getattr(server, 'created', None):
+                    for address in self.addresses[server_id]:
+                        self.created[address] = readiness.parse_created(
+                            server.created)
+
+        ret = set()
+        for addresses in self.addresses.itervalues():
+            ret.update(addresses)
+        return ret
+
+
+class DrainState(object):
+    """ When each draining node started draining, persisted in
+        drain_state_file so it survives between runs
+    """
+
+    def __init__(self, state_file):
+        self.state_file = state_file
         try:
-            nodes = lb.nodes
-        except AttributeError as e:
-            # This is thrown when there are no nodes under an LB
-            continue
+            with open(state_file, 'r') as fp:
+                self.started = json.load(fp)
+        except (IOError, ValueError):
+            self.started = {}
+
+    def key(self, lb_id, node):
+        return "%s/%s" % (lb_id, node.id)
+
+    def get_started(self, lb_id, node, now):
+        """ Returns when the node started draining. Nodes we have no record
+            of (e.g. drained by hand) are counted from now
+        """
+        return self.started.setdefault(self.key(lb_id, node), now)
+
+    def start(self, lb_id, node, now):
+        self.started[self.key(lb_id, node)] = now
+
+    def forget(self, lb_id, node):
+        self.started.pop(self.key(lb_id, node), None)
+
+    def prune(self, lb_id, nodes):
+        """ Drops records of nodes no longer draining in a load balancer """
+        draining = set(self.key(lb_id, node) for node in nodes
+                       if node.condition == 'DRAINING')
+        prefix = "%s/" % lb_id
+        for key in self.started.keys():
+            if key.startswith(prefix) and key not in draining:
+                del self.started[key]
+
+    def save(self):
+        tmp_file = "%s.%d.tmp" % (self.state_file, os.getpid())
+        try:
+            with open(tmp_file, 'w') as fp:
+                json.dump(self.started, fp)
+            os.rename(tmp_file, self.state_file)
+        except (IOError, OSError) as ex:
+            log_root.warning("Unable to save drain state: %s" % ex)
+
+
+class NodePlan(object):
+    """ What to do with the nodes of a single load balancer, worked out before
+        anything is changed. Nodes not backed by a group member (or the
+        whitelist) are drained, and deleted once they have drained for
+        drain_timeout seconds. OFFLINE nodes have no connections to drain and
+        are deleted straight away, as are draining ones once the load balancer
+        has no connections left (see release_drained()). Online ones are kept
+        unless delete_online is set.
+    """
+
+    def __init__(self, lb_id, nodes, addresses_in_grp, drain_state, now):
+        self.lb_id = lb_id
+        self.drain = []
+        self.delete = []
+        self.keep = []
+        # Nodes still draining, with the time they may be deleted
+        self.waiting = []
+
+        drain_state.prune(lb_id, nodes)
+        stray = set(node.address for node in nodes) - addresses_in_grp
         for node in nodes:
-            if node.address not in addresses_in_grp and (node.status != "ONLINE" or delete_online):
-                pyrax.utils.wait_until(
-                    lb, "status", "ACTIVE", interval=1, attempts=30, verbose=False)
-                if node.condition != 'DRAINING':
-                    log_root.info("%s (status: %s) not found in scaling group or whitelist, "
-                                    "draining node in loadbalancer %s..." % (
-                                    node.address, node.status, id))
-                    node.condition = 'DRAINING'
-                    node.update()
+            if node.address not in stray:
+                continue
+            if node.status == "ONLINE" and not delete_online:
+                self.keep.append(node)
+            elif node.status == "OFFLINE":
+                self.delete.append(node)
+            elif node.condition != 'DRAINING':
+                self.drain.append(node)
+            else:
+                expires = drain_state.get_started(lb_id, node, now) + \
+                    drain_timeout
+                if expires <= now:
+                    self.delete.append(node)
                 else:
-                    log_root.info("%s (status: %s) not found in scaling group or whitelist, "
-                                    "and is in draining mode - deleting from "
-                                    "loadbalancer %s..." % (
-                                                        node.address,
-                                                        node.status,
-                                                        id))
-                    node.delete()
-            elif node.address not in addresses_in_grp and (node.status == "ONLINE" and not delete_online):
-                print("Node %s in LB %s not in autoscale group, but is online and we are not overriding." % (
-                        node.address, id))
+                    self.waiting.append((node, expires))
+
+    def release_drained(self, current_connections):
+        """ Deletes the draining nodes without waiting for drain_timeout if
+            the load balancer has no connections left, as then none of them
+            can have any either. current_connections is None when unknown
+        """
+        if current_connections != 0:
+            return
+        self.delete.extend(node for node, expires in self.waiting)
+        self.waiting = []
+
+    def is_empty(self):
+        return not (self.drain or self.delete)
+
+    def next_expiry(self):
+        """ Returns when the next draining node may be deleted, or None """
+        expiries = [expires for node, expires in self.waiting]
+        if self.drain:
+            expiries.append(time.time() + drain_timeout)
+        return min(expiries) if expiries else None
+
+
+def get_current_connections(lb):
+    """ Returns the number of connections the load balancer currently has,
+        or None if they can't be found out
+    """
+    try:
+        return lb.get_stats().get('currentConn')
+    except Exception as ex:
+        log_root.warning("Unable to get the connections of loadbalancer %s:"
+                         " %s" % (lb.id, ex))
+        return None
+
+
+def apply_plan(lb, plan, drain_state):
+    policy = RetryPolicy(deadline=retry_deadline)
+
+    def change_node(func):
+        policy.wait_until(lb, "status", "ACTIVE")
+        func()
+
+    for node in plan.drain:
+        log_root.info("%s (status: %s) not found in scaling group or whitelist, "
+                      "draining node in loadbalancer %s..." % (
+                          node.address, node.status, plan.lb_id))
+        node.condition = 'DRAINING'
+        policy.call(change_node, node.update)
+        drain_state.start(plan.lb_id, node, time.time())
+
+    for node in plan.delete:
+        log_root.info("%s (status: %s, condition: %s) not found in scaling"
+                      " group or whitelist, deleting from loadbalancer"
+                      " %s..." % (node.address, node.status, node.condition,
+                                  plan.lb_id))
+        policy.call(change_node, node.delete)
+        drain_state.forget(plan.lb_id, node)
+
+    for node in plan.keep:
+        print("Node %s in LB %s not in autoscale group, but is online and we are not overriding." % (
+            node.address, plan.lb_id))
+
+
+def write_status(group_state, lb_nodes, duration):
+    """ Saves what this run saw of the group and the load balancer(s).
+        lb_nodes maps LB IDs to their nodes. The time of the last change in
+        the group's desired capacity is carried over between runs
+    """
+    now = time.time()
+    try:
+        with open(status_file, 'r') as fp:
+            previous = json.load(fp)
+    except (IOError, ValueError):
+        previous = {}
+
+    last_scale_event = previous.get('last_scale_event')
+    if previous.get('desired_capacity') != group_state.get('desired_capacity'):
+        last_scale_event = now if previous else None
+
+    status = {'time': now,
+              'reconcile_duration': duration,
+              'desired_capacity': group_state.get('desired_capacity'),
+              'active_capacity': group_state.get('active_capacity'),
+              'pending_capacity': group_state.get('pending_capacity'),
+              'last_scale_event': last_scale_event,
+              'load_balancers': {}}
+    for lb_id, nodes in lb_nodes.iteritems():
+        counts = {}
+        for node in nodes:
+            key = "%s/%s" % (node.condition, node.status)
+            counts[key] = counts.get(key, 0) + 1
+        status['load_balancers'][str(lb_id)] = counts
+
+    tmp_file = "%s.%d.tmp" % (status_file, os.getpid())
+    try:
+        with open(tmp_file, 'w') as fp:
+            json.dump(status, fp)
+        os.rename(tmp_file, status_file)
+    except (IOError, OSError) as ex:
+        log_root.warning("Unable to save status: %s" % ex)
+
+
+@timing.timed('reconcile')
+def reconcile(clb, asg, address_cache):
+    """ Returns when the next draining node may be deleted, or None if no
+        node is draining
+    """
+    started = time.time()
+    group_state = asg.get_state()
+    # Pretend that all whitelisted servers are in the group
+    addresses_in_grp = set(whitelist or [])
+    addresses_in_grp.update(address_cache.update(group_state.get('active')))
+
+    drain_state = DrainState(drain_state_file)
+    next_expiry = None
+    lb_nodes = {}
+    try:
+        for id in lbs:
+            with timing.span('reconcile_lb'):
+                lb = clb.get(id)
+                try:
+                    nodes = lb.nodes
+                except AttributeError as e:
+                    # This is thrown when there are no nodes under an LB
+                    drain_state.prune(id, [])
+                    lb_nodes[id] = []
+                    continue
+                lb_nodes[id] = nodes
+                plan = NodePlan(id, nodes, addresses_in_grp, drain_state,
+                                time.time())
+                if plan.waiting:
+                    plan.release_drained(get_current_connections(lb))
+                apply_plan(lb, plan, drain_state)
+            expiry = plan.next_expiry()
+            if expiry is not None and (next_expiry is None or
+                                       expiry < next_expiry):
+                next_expiry = expiry
+    finally:
+        drain_state.save()
+    if status_file:
+        write_status(group_state, lb_nodes, time.time() - started)
+    if TriggerHandler.readiness_log:
+        TriggerHandler.readiness_log.fill_created(address_cache.created.get)
+    return next_expiry
+
+
+def reconcile_until_drained(clb, asg, address_cache):
+    """ Reconciles, and as long as nodes are draining keeps waiting for the
+        next drain to expire and reconciling again, so a run leaves nothing
+        draining behind it
+    """
+    next_expiry = reconcile(clb, asg, address_cache)
+    give_up_at = time.time() + drain_timeout
+    while next_expiry is not None and next_expiry <= give_up_at:
+        time.sleep(max(0, next_expiry - time.time()))
+        next_expiry = reconcile(clb, asg, address_cache)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TriggerHandler(BaseHTTPRequestHandler):
+    trigger = None
+    readiness_log = None
+
+    def do_POST(self):
+        if self.path.rstrip('/') == '/readiness':
+            return self.add_readiness()
+        self.do_GET()
+
+    def do_GET(self):
+        log_root.info("Reconciliation requested by %s" % self.client_address[0])
+        self.trigger.set()
+        self.send_response(202)
+        self.end_headers()
+
+    def add_readiness(self):
+        try:
+            length = int(self.headers.getheader('content-length') or 0)
+            record = json.loads(self.rfile.read(length))
+            self.readiness_log.add(record)
+        except (ValueError, TypeError, AttributeError) as ex:
+            self.send_error(400, str(ex))
+            return
+        except (IOError, OSError) as ex:
+            log_root.warning("Unable to save readiness report: %s" % ex)
+            self.send_error(500, str(ex))
+            return
+        log_root.info("Readiness reported by %s" % record.get('address'))
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        log_root.debug(format % args)
+
+
+def start_listener(trigger):
+    server = ThreadingHTTPServer((listen_address, listen_port),
+                                 TriggerHandler)
+    TriggerHandler.trigger = trigger
+    TriggerHandler.readiness_log = readiness.ReadinessLog(
+        readiness.readiness_file)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    log_root.info("Accepting reconciliation requests on %s:%s" % (
+        listen_address, listen_port))
+
+
+def run_daemon(clb, asg, address_cache, interval, trigger=None):
+    """ Reconciles every interval seconds, reusing the authenticated session
+        and the cached server addresses across runs. If given a trigger
+        event, setting it starts a reconciliation straight away
+    """
+    while True:
+        started = time.time()
+        next_expiry = None
+        try:
+            next_expiry = reconcile(clb, asg, address_cache)
+        except Exception:
+            log_root.exception("Reconciliation failed, retrying in %s"
+                               " seconds" % interval)
+        timing.flush()
+        wake_at = started + interval
+        if next_expiry is not None:
+            # Come back in time to delete the next drained node
+            wake_at = min(wake_at, next_expiry)
+        remaining = max(0, wake_at - time.time())
+        if trigger is None:
+            time.sleep(remaining)
+        elif trigger.wait(remaining):
+            # A scale event fires several webhooks, handle them all at once
+            time.sleep(listen_debounce)
+            trigger.clear()
+
+
+def get_api(timer):
+    """ Returns the authenticated pyrax module, or the lightweight stand-in
+        for it. pyrax is only imported when it is going to be used
+    """
+    if lightweight_client:
+        with timer.phase('import'):
+            import light_client
+        with timer.phase('auth'):
+            return light_client.connect(credentials)
+
+    with timer.phase('import'):
+        import pyrax
+    with timer.phase('auth'):
+        pyrax.set_setting("identity_type", "rackspace")
+        token_cache.authenticate(pyrax, credential_file=credentials)
+    return pyrax
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        'Remove load balancer nodes not in the autoscale group')
+    parser.add_argument('--daemon', required=False, action="store_true",
+                        help='Keep running and reconcile periodically'
+                             ' rather than exiting after one run')
+    parser.add_argument('--interval', type=int, default=daemon_interval,
+                        help='Seconds between reconciliations with --daemon'
+                             ' (default %d)' % daemon_interval)
+    parser.add_argument('--listen', required=False, action="store_true",
+                        help='Run as with --daemon, and also reconcile'
+                             ' whenever a request is made to'
+                             ' http://%s:%d/' % (listen_address, listen_port))
+    parser.add_argument('--profile-startup', required=False,
+                        action="store_true",
+                        help='Report the time spent importing modules,'
+                             ' authenticating and making API calls')
+    parser.add_argument('--metrics-file', type=str, default=metrics_file,
+                        help='Record the timing of every API call in this'
+                             ' file (.prom for Prometheus text format,'
+                             ' JSON lines otherwise)')
+    args = parser.parse_args()
+
+    if args.metrics_file:
+        timing.install(args.metrics_file)
+    timer = PhaseTimer()
+    api = get_api(timer)
+    clb = api.cloud_loadbalancers
+    asg = api.autoscale.get(as_group)
+    address_cache = AddressCache(api.cloudservers)
+
+    if args.listen:
+        trigger = threading.Event()
+        start_listener(trigger)
+        run_daemon(clb, asg, address_cache, args.interval, trigger)
+    elif args.daemon:
+        run_daemon(clb, asg, address_cache, args.interval)
+    else:
+        with timer.phase('reconcile'):
+            reconcile_until_drained(clb, asg, address_cache)
+        if args.profile_startup:
+            timer.report(api)
 
 if __name__ == "__main__":
     main()
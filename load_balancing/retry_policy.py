@@ -0,0 +1,90 @@
+"""
+Retry policy shared by the load balancing scripts.
+
+Cloud load balancers are immutable while an update is in progress, so when
+several servers add or remove nodes at the same time most of the requests are
+rejected with a PENDING_UPDATE error. Retrying those on a fixed interval (or
+with a plain random sleep) makes every client come back at roughly the same
+time. RetryPolicy instead spaces retries out with "decorrelated jitter"
+exponential backoff, each delay being drawn between the base delay and three
+times the previous one, capped, until a deadline passes.
+
+License: Apache License Version 2.0 http://www.apache.org/licenses/LICENSE-2.0
+"""
+
+import time
+import random
+import timing
+
+
+class NotReady(Exception):
+    """ Raised by RetryPolicy.wait_until() when a resource doesn't get to the
+        desired state in time. The message names the state it was left in, so
+        one still in PENDING_UPDATE is retried by RetryPolicy.call()
+    """
+
+
+class RetryPolicy(object):
+    """ Decides which errors are worth retrying and how long to wait in
+        between attempts.
+        base and cap bound each delay, deadline bounds the total time (all
+        in seconds). An error is retried if its HTTP status code is in
+        retry_codes, or its message contains one of retry_messages.
+    """
+
+    def __init__(self, base=0.5, cap=10, deadline=120,
+                 retry_codes=(413, 500, 503),
+                 retry_messages=('PENDING', 'immutable')):
+        self.base = base
+        self.cap = cap
+        self.deadline = deadline
+        self.retry_codes = retry_codes
+        self.retry_messages = retry_messages
+
+    def is_retryable(self, exc):
+        """ Classifies an exception, such as a pyrax ClientException, as
+            transient or not
+        """
+        if getattr(exc, 'code', None) in self.retry_codes:
+            return True
+        message = str(getattr(exc, 'message', None) or exc)
+        return any(m in message for m in self.retry_messages)
+
+    def delays(self):
+        """ Yields an endless sequence of backoff delays """
+        delay = self.base
+        while True:
+            delay = min(self.cap, random.uniform(self.base, delay * 3))
+            yield delay
+
+    def call(self, func, *args, **kwargs):
+        """ Calls func until it succeeds, it raises an error that isn't
+            retryable, or the deadline passes. In the latter two cases the
+            last error is re-raised.
+        """
+        give_up_at = time.time() + self.deadline
+        for delay in self.delays():
+            try:
+                return func(*args, **kwargs)
+            except Exception as exc:
+                if not self.is_retryable(exc) or \
+                   time.time() + delay > give_up_at:
+                    raise
+                timing.record_retry(exc)
+            time.sleep(delay)
+
+    def wait_until(self, obj, att, desired, timeout=30):
+        """ Reloads a pyrax resource until its attribute att equals desired,
+            backing off between polls. Returns True once it gets there, and
+            raises NotReady if that doesn't happen within timeout seconds.
+        """
+        give_up_at = time.time() + timeout
+        with timing.span('wait_until'):
+            for delay in self.delays():
+                obj.get()
+                if getattr(obj, att, None) == desired:
+                    return True
+                if time.time() + delay > give_up_at:
+                    raise NotReady("%s is %s rather than %s after %ss" % (
+                        att, getattr(obj, att, None), desired, timeout))
+                time.sleep(delay)
@@ -0,0 +1,231 @@
+"""
+Timing of script runs and of the API calls they make.
+
+PhaseTimer measures the phases of a run, as reported by --profile-startup.
+
+install() sets up Metrics, which records every HTTP request made through the
+requests library (which pyrax, novaclient and light_client all use
+underneath) with its duration and status, every retry made by RetryPolicy,
+and the duration of named spans such as a reconciliation. flush() writes
+them out to a file, as JSON lines or, if the file name ends in .prom, in the
+Prometheus text format (e.g. for node_exporter's textfile collector).
+Without install() all of this is a no-op.
+
+License: Apache License Version 2.0 http://www.apache.org/licenses/LICENSE-2.0
+"""
+
+from __future__ import print_function
+
+import os
+import re
+import atexit
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# Upper bounds of the request duration histogram buckets, in seconds
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Path segments that are IDs, replaced so requests can be grouped by endpoint
+ID_SEGMENT = re.compile(r'/(?:[0-9a-fA-F-]{32,36}|\d+)(?=/|$)')
+
+_metrics = None
+
+
+class Metrics(object):
+    """ Collects API call, retry and span records for one process """
+
+    def __init__(self, metrics_file):
+        self.metrics_file = metrics_file
+        self.lock = threading.Lock()
+        # Records not yet written out as JSON lines
+        self.pending = []
+        # Aggregates for the Prometheus output:
+        # (host, method, endpoint, status) -> [bucket counts, sum, count]
+        self.requests = {}
+        # reason -> count
+        self.retries = {}
+        # name -> (last duration, count)
+        self.spans = {}
+
+    def record(self, record):
+        with self.lock:
+            record['time'] = time.time()
+            self.pending.append(record)
+            if record['type'] == 'request':
+                key = (record['host'], record['method'], record['endpoint'],
+                       str(record['status']))
+                buckets, total, count = self.requests.get(
+                    key, ([0] * len(BUCKETS), 0.0, 0))
+                buckets = [n + (record['duration'] <= le)
+                           for n, le in zip(buckets, BUCKETS)]
+                self.requests[key] = (buckets, total + record['duration'],
+                                      count + 1)
+            elif record['type'] == 'retry':
+                self.retries[record['reason']] = \
+                    self.retries.get(record['reason'], 0) + 1
+            elif record['type'] == 'span':
+                count = self.spans.get(record['name'], (0, 0))[1]
+                self.spans[record['name']] = (record['duration'], count + 1)
+
+    def prometheus(self):
+        lines = ['# TYPE autoscale_api_request_duration_seconds histogram']
+        for (host, method, endpoint, status), (buckets, total, count) in \
+                sorted(self.requests.items()):
+            labels = 'host="%s",method="%s",endpoint="%s",status="%s"' % (
+                host, method, endpoint, status)
+            for le, n in zip(BUCKETS, buckets):
+                lines.append('autoscale_api_request_duration_seconds_bucket'
+                             '{%s,le="%s"} %d' % (labels, le, n))
+            lines.append('autoscale_api_request_duration_seconds_bucket'
+                         '{%s,le="+Inf"} %d' % (labels, count))
+            lines.append('autoscale_api_request_duration_seconds_sum{%s} %f'
+                         % (labels, total))
+            lines.append('autoscale_api_request_duration_seconds_count{%s} %d'
+                         % (labels, count))
+        lines.append('# TYPE autoscale_api_retries_total counter')
+        for reason, count in sorted(self.retries.items()):
+            lines.append('autoscale_api_retries_total{reason="%s"} %d' % (
+                reason, count))
+        lines.append('# TYPE autoscale_span_duration_seconds gauge')
+        for name, (duration, count) in sorted(self.spans.items()):
+            lines.append('autoscale_span_duration_seconds{name="%s"} %f' % (
+                name, duration))
+        lines.append('# TYPE autoscale_span_total counter')
+        for name, (duration, count) in sorted(self.spans.items()):
+            lines.append('autoscale_span_total{name="%s"} %d' % (name, count))
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        """ Appends new records to a JSON lines file, or rewrites the
+            Prometheus text file with everything recorded so far
+        """
+        with self.lock:
+            pending, self.pending = self.pending, []
+            if self.metrics_file.endswith('.prom'):
+                # Written to a temporary file first, so collectors never see
+                # a partial file
+                tmp_file = '%s.%d.tmp' % (self.metrics_file, os.getpid())
+                with open(tmp_file, 'w') as fp:
+                    fp.write(self.prometheus())
+                os.rename(tmp_file, self.metrics_file)
+            elif pending:
+                with open(self.metrics_file, 'a') as fp:
+                    for record in pending:
+                        fp.write(json.dumps(record) + '\n')
+
+
+def _instrument_requests(metrics):
+    """ Wraps requests' Session.request, which every HTTP request made by
+        pyrax, novaclient, light_client and utils goes through
+    """
+    import requests
+    from urlparse import urlparse
+
+    original = requests.sessions.Session.request
+    if getattr(original, 'instrumented', False):
+        return
+
+    def request(self, method, url, *args, **kwargs):
+        started = time.time()
+        status = None
+        try:
+            response = original(self, method, url, *args, **kwargs)
+            status = response.status_code
+            return response
+        except Exception as ex:
+            status = type(ex).__name__
+            raise
+        finally:
+            parsed = urlparse(url)
+            metrics.record({'type': 'request',
+                            'method': method.upper(),
+                            'host': parsed.hostname,
+                            'endpoint': ID_SEGMENT.sub('/{id}', parsed.path),
+                            'status': status,
+                            'duration': time.time() - started})
+
+    request.instrumented = True
+    requests.sessions.Session.request = request
+
+
+def install(metrics_file):
+    """ Starts recording to metrics_file, which is flushed when the process
+        exits. Returns the Metrics object
+    """
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics(metrics_file)
+        _instrument_requests(_metrics)
+        atexit.register(flush)
+    return _metrics
+
+
+def flush():
+    if _metrics is not None:
+        _metrics.flush()
+
+
+def record_retry(exc):
+    """ Called by RetryPolicy for every retry it makes """
+    if _metrics is not None:
+        _metrics.record({'type': 'retry',
+                         'reason': str(getattr(exc, 'code', None) or
+                                       type(exc).__name__),
+                         'message': str(getattr(exc, 'message', None) or
+                                        exc)})
+
+
+@contextmanager
+def span(name):
+    """ Records how long the body of the with statement took """
+    started = time.time()
+    try:
+        yield
+    finally:
+        if _metrics is not None:
+            _metrics.record({'type': 'span', 'name': name,
+                             'duration': time.time() - started})
+
+
+def timed(name):
+    """ Decorator recording each call of a function as a span """
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+
+class PhaseTimer(object):
+    """ Records how long each named phase took, in the order they ran """
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        started = time.time()
+        try:
+            with span(name):
+                yield
+        finally:
+            self.phases.append((name, time.time() - started))
+
+    def report(self, api=None):
+        """ Prints the time spent in each phase. If given the lightweight
+            client's Api, also prints the number of API calls and the time
+            spent on them
+        """
+        for name, seconds in self.phases:
+            print("%-10s %8.3fs" % (name, seconds))
+        client = getattr(api, 'client', None)
+        if client:
+            print("%-10s %8.3fs (%d calls)" % ('api calls', client.api_time,
+                                               client.api_calls))
+        print("%-10s %8.3fs" % ('total', time.time() - self.started))
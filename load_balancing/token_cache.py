@@ -0,0 +1,123 @@
+"""
+On-disk cache of the identity token and service catalog.
+
+Every run of main.py, add_self_to_lb.py and remove_dead_nodes.py used to
+authenticate from scratch, which is a full round trip to the identity service
+to fetch a token and the service catalog. The response is valid for hours, so
+authenticate() stores it in a file only readable by the current user and
+restores pyrax's identity from it on the next run, as long as the token has
+not expired (or is about to). When a cached token is rejected, pyrax
+re-authenticates by itself and the fresh response is written back to the
+cache.
+
+License: Apache License Version 2.0 http://www.apache.org/licenses/LICENSE-2.0
+"""
+
+import os
+import json
+import time
+import stat
+import hashlib
+import calendar
+
+DEFAULT_CACHE_DIR = os.path.expanduser('~/.cache/autoscale_setup')
+
+# Don't use tokens that expire within this many seconds
+EXPIRY_MARGIN = 300
+
+
+def get_cache_file(cache_dir, username):
+    return os.path.join(cache_dir, 'token-%s.json' %
+                        hashlib.sha1(username).hexdigest())
+
+
+def get_expiry(access):
+    """ Returns the expiry time of the token in an identity response as a
+        unix timestamp
+    """
+    expires = access['access']['token']['expires']
+    return calendar.timegm(time.strptime(expires[:19], '%Y-%m-%dT%H:%M:%S'))
+
+
+def read_cache(cache_file):
+    """ Returns the cached identity response, or None if there is no usable
+        one. Files anyone but the current user could have written or read
+        are ignored
+    """
+    try:
+        st = os.stat(cache_file)
+        if st.st_uid != os.getuid() or \
+           st.st_mode & (stat.S_IRWXG | stat.S_IRWXO):
+            return None
+        with open(cache_file, 'r') as fp:
+            access = json.load(fp)
+        if get_expiry(access) - EXPIRY_MARGIN < time.time():
+            return None
+        return access
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def write_cache(cache_file, access):
+    """ Atomically replaces the cache file, readable by the current user
+        only
+    """
+    cache_dir = os.path.dirname(cache_file)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0700)
+        tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(access, fp)
+        os.rename(tmp_file, cache_file)
+    except (IOError, OSError):
+        # Not being able to cache the token is no reason to fail
+        pass
+
+
+def authenticate(pyrax, username=None, api_key=None, credential_file=None,
+                 region=None, cache_dir=DEFAULT_CACHE_DIR):
+    """ Sets up pyrax the way set_credentials() or set_credential_file()
+        would, but only contacts the identity service when there is no
+        valid cached token for the user
+    """
+    # pyrax.set_credentials() and set_credential_file() connect to the
+    # services even with authenticate=False, which fails without a token,
+    # so the credentials are set on the identity object itself
+    pyrax._create_identity()
+    identity = pyrax.identity
+    region = region or pyrax.get_setting('region')
+    if credential_file:
+        identity.set_credential_file(credential_file, region=region)
+    else:
+        identity.set_credentials(username, password=api_key, region=region)
+    cache_file = get_cache_file(cache_dir, identity.username)
+
+    # Store every response pyrax parses, including when it re-authenticates
+    # by itself after the token has been rejected
+    parse_response = identity._parse_response
+
+    def parse_and_cache(access):
+        ret = parse_response(access)
+        write_cache(cache_file, access)
+        return ret
+
+    access = read_cache(cache_file)
+    restored = False
+    if access:
+        try:
+            parse_response(access)
+            identity.authenticated = True
+            restored = True
+        except Exception:
+            restored = False
+    identity._parse_response = parse_and_cache
+    if not restored:
+        identity.authenticate()
+    if not identity.authenticated:
+        raise pyrax.exceptions.AuthenticationFailed(
+            "Unable to authenticate as %s" % identity.username)
+    pyrax.regions = tuple(identity.regions)
+    pyrax.services = tuple(identity.services.keys())
+    pyrax.connect_to_services(region or pyrax._safe_region())
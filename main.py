@@ -5,6 +5,9 @@ import utils
 import autoscale
 import argparse
 import create_config
+import reconcile
+from load_balancing import token_cache
+from load_balancing import timing
 from colors import bcolors
 
 
@@ -19,8 +22,39 @@ def main():
                         default='/opt/autoscale/autoscaler.ini',
                         help='Path to config file (default'
                              ' /opt/autoscale/autoscaler.ini)')
+    parser.add_argument('--config-dir', type=str, required=False,
+                        help='Manage every group configured in the .ini'
+                             ' files in this directory, rather than the'
+                             ' single group in --config-file')
+    parser.add_argument('--max-workers', type=int, default=8,
+                        help='Number of groups to diff and update'
+                             ' concurrently with --config-dir (default 8)')
+    parser.add_argument('--assume-yes', required=False,
+                        action="store_true",
+                        help='Update groups found to differ from their'
+                             ' config files without prompting'
+                             ' (--config-dir only)')
+    parser.add_argument('--detailed-diff', required=False,
+                        action="store_true",
+                        help='Show which keys of the launch configuration'
+                             ' differ from the config file, rather than'
+                             ' only that it does')
+    parser.add_argument('--metrics-file', type=str, required=False,
+                        help='Record the timing of every API call in this'
+                             ' file (.prom for Prometheus text format,'
+                             ' JSON lines otherwise)')
     args = parser.parse_args()
 
+    if args.metrics_file:
+        timing.install(args.metrics_file)
+
+    if args.config_dir:
+        results = reconcile.reconcile(args.config_dir,
+                                      max_workers=args.max_workers,
+                                      assume_yes=args.assume_yes,
+                                      detailed_diff=args.detailed_diff)
+        exit(1 if any(r.error for r in results) else 0)
+
     """ We need to parse the config file first of all, since we need a pyrax
     client for creating and further parsing the config file we require
     a minimal config with at least cloud credentials in it
@@ -30,7 +64,8 @@ def main():
 
     pyrax.set_setting('identity_type', 'rackspace')
     pyrax.set_setting('region', region)
-    pyrax.set_credentials(username, api_key)
+    token_cache.authenticate(pyrax, username=username, api_key=api_key,
+                             region=region)
 
     if not args.no_create_config:
         create_config.write_config(config, pyrax)
@@ -43,7 +78,8 @@ def main():
 
     while True:
         try:
-            auto_scale = autoscale.autoscale(config, pyrax)
+            auto_scale = autoscale.autoscale(
+                config, pyrax, detailed_diff=args.detailed_diff)
             break
         except pyrax.exceptions.NotFound:
             question = (bcolors.FAIL + "You specified a scaling group"
@@ -68,10 +104,11 @@ def main():
     config.set_config_option('rax-autoscaler', 'scale_down_webhook',
                              auto_scale.get_webhook_url(scale_down))
     config.set_config_option('rax-autoscaler', 'scale_up_policy',
-                             auto_scale.get_scale_up_policy().id)
+                             scale_up.id)
     config.set_config_option('rax-autoscaler', 'scale_down_policy',
-                             auto_scale.get_scale_down_policy().id)
+                             scale_down.id)
     config.set_config_option('autoscale', 'id', auto_scale.get_id())
+    config.flush()
 
     create_config.generate_rax_as_config(config)
 
@@ -2,7 +2,7 @@
 
 """ This file is a Rackspace Cloud Monitoring plugin, which will monitor
     for the existence of /tmp/rax_autoscale_failure, which is created by
-    wrapper.sh if rax-autoscaler detects that there are nodes in the
+    wrapper.py if rax-autoscaler detects that there are nodes in the
     autoscale group that isn't in the load balancer.
     In that case, rax-autoscaler will refuse to scale down, and we should be
     alerted in that scenario.
@@ -10,15 +10,125 @@
     Set up a normal cloud monitor check on the server running rax-autoscaler
     of type agent.plugin (API only), and add an alert if the metric is 1.
 
+    Alongside that, it reports the state of the scaling group and load
+    balancer(s) as last seen by load_balancing/remove_dead_nodes.py (which
+    writes it to status_file on every run), so no API calls are made here:
+     - desired, active and pending capacity of the group
+     - number of nodes in each load balancer by condition and status
+     - seconds since the group's desired capacity last changed
+     - number of consecutive runs rax-autoscaler was blocked from scaling
+       down (from wrapper.py's fail count file)
+     - how long the last reconciliation took, and how old that data is
+    If prometheus_file is set, the same metrics are also written there in
+    the Prometheus text format, e.g. for node_exporter's textfile collector.
+
     This is completely optional, and you may have other ways of being alerted
     in the event of servers failing to be bootstrapped.
 """
 
+import os
+import re
+import errno
+import json
+import time
+
 fail_file = "/tmp/rax_autoscale_failure"
+fail_count_file = "/tmp/rax_autoscale_fails"
+status_file = "/var/tmp/remove_dead_nodes.status.json"
+prometheus_file = None
+
+
+def read_fail_count():
+    try:
+        with open(fail_count_file, 'r') as fp:
+            return int(fp.read().strip() or 0)
+    except (IOError, ValueError):
+        return 0
+
+
+def read_status():
+    """ Returns the status last written by remove_dead_nodes.py, or None if
+        it hasn't written one (yet). Raises IOError or ValueError if the
+        file is there but can't be read
+    """
+    try:
+        with open(status_file, 'r') as fp:
+            return json.load(fp)
+    except IOError as ex:
+        if ex.errno == errno.ENOENT:
+            return None
+        raise
+
+
+def metric_name(*parts):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', '_'.join(str(p) for p in parts)).lower()
+
+
+def collect():
+    """ Returns a list of (name, type, value, labels) tuples, and a status
+        message
+    """
+    now = time.time()
+    metrics = [('rax_autoscale_fail', 'int64',
+                int(os.path.exists(fail_file)), {}),
+               ('scale_down_blocked_runs', 'int64', read_fail_count(), {})]
+    try:
+        status = read_status()
+    except (IOError, ValueError) as ex:
+        return metrics, "err unable to read %s: %s" % (status_file, ex)
+    if status is None:
+        # remove_dead_nodes.py doesn't write a status, or hasn't run yet
+        return metrics, "ok"
+
+    for key in ('desired_capacity', 'active_capacity', 'pending_capacity'):
+        if status.get(key) is not None:
+            metrics.append(('group_' + key, 'int64', status[key], {}))
+    if status.get('last_scale_event'):
+        metrics.append(('seconds_since_scale_event', 'int64',
+                        int(now - status['last_scale_event']), {}))
+    metrics.append(('reconcile_duration', 'double',
+                    status.get('reconcile_duration', 0), {}))
+    metrics.append(('status_age', 'int64', int(now - status['time']), {}))
+    for lb_id, counts in sorted(status.get('load_balancers', {}).items()):
+        for key, count in sorted(counts.items()):
+            condition, node_status = key.split('/', 1)
+            metrics.append(('lb_nodes', 'int64', count,
+                            {'lb': lb_id, 'condition': condition,
+                             'status': node_status}))
+    return metrics, "ok"
+
+
+def print_plugin_output(metrics, message):
+    print "status %s" % message
+    for name, type, value, labels in metrics:
+        if labels:
+            name = metric_name(name, labels['lb'], labels['condition'],
+                               labels['status'])
+        print "metric %s %s %s" % (name, type, value)
+
+
+def write_prometheus(metrics):
+    lines = []
+    for name, type, value, labels in metrics:
+        if not name.startswith('rax_autoscale'):
+            name = 'rax_autoscale_' + name
+        # All of them can go up and down. Labelled metrics come one after
+        # another, and only need it once
+        type_line = "# TYPE %s gauge" % name
+        if type_line not in lines:
+            lines.append(type_line)
+        if labels:
+            name += '{%s}' % ','.join('%s="%s"' % (k, v)
+                                      for k, v in sorted(labels.items()))
+        lines.append("%s %s" % (name, value))
+    tmp_file = "%s.%d.tmp" % (prometheus_file, os.getpid())
+    with open(tmp_file, 'w') as fp:
+        fp.write('\n'.join(lines) + '\n')
+    os.rename(tmp_file, prometheus_file)
+
 
-try:
-    fp = open(fail_file, 'r')
-    fp.close()
-    print "metric rax_autoscale_fail int64 1"
-except IOError:
-    print "metric rax_autoscale_fail int64 0"
+if __name__ == '__main__':
+    metrics, message = collect()
+    print_plugin_output(metrics, message)
+    if prometheus_file:
+        write_prometheus(metrics)
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+
+""" This file executes 'rax-autoscaler' and checks whether the output
+    indicates that there is a need to 'scale down' but NOT all the nodes in
+    the autoscale group are in the load balancer.
+
+    This could be simply because rax-autoscaler checked while the new server
+    was still building/configuring or a real issue and we need a way to be
+    notified if this keeps happening for too long, to avoid to get autoscale
+    stuck with the autoscale max_nodes limit reached without actually serving
+    traffic and the inability to scale down.
+
+    The output of rax-autoscaler is read line by line as it runs, and appended
+    to LOG_FILE. That is rotated once it grows past LOG_MAX_BYTES or at the
+    start of every LOG_ROTATE_INTERVAL seconds, keeping LOG_BACKUP_COUNT old
+    logs, gzipped if LOG_COMPRESS is set.
+    If a line says "Consensus was to scale down", the number of failures in a
+    row is increased and saved in FAIL_COUNT, and once it goes over
+    MAX_FAILURES the output of the most recent runs is written to FAIL_FILE.
+    This file is monitored by fail_file_monitor.py (check header of that file
+    for more information). Once the status goes back to normal (scale_up,
+    scale_down or do_nothing), the counter and alert file are reset.
+
+    Run from cron, or with --interval to keep running and run rax-autoscaler
+    every so many seconds. Only the last RECENT_RUNS runs, and the last
+    RUN_MAX_LINES lines of each, are kept in memory for the fail file (when
+    run from cron, that is only the current run).
+
+    MAX_FAILURES should be calculated in this way:
+    ((av_time_new_server_ready / rax-autoscaler_cron_time)) x2
+
+    the 'x2' is more as a precaution to allow some buffer in case a server
+    requires more time. We allow DOUBLE time.
+
+    Example:
+    15 minutes average time to have a server built and configured
+    rax-autoscaler set in cron to run every 2 minutes
+    this means => ~7-8 runs x 2 = 14-16 MAX_FAILURES
+
+    Rather than guessing, load_balancing/readiness.py can measure the time
+    it takes servers to go into service and work this out from it. Point
+    READINESS_FILE at its summary_file to use that value instead, once
+    there is one.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import gzip
+import json
+import time
+import shutil
+import logging
+import argparse
+import subprocess
+from collections import deque
+from logging.handlers import RotatingFileHandler
+
+# Please set this variable accordingly with your setup (see above)
+MAX_FAILURES = 15
+READINESS_FILE = None
+
+AUTOSCALE_COMMAND = ['/usr/bin/autoscale', '--config',
+                     '/opt/autoscale/autoscale_setup/rax-autoscaler-config.json']
+
+FAIL_FILE = '/tmp/rax_autoscale_failure'
+FAIL_COUNT = '/tmp/rax_autoscale_fails'
+LOG_FILE = '/var/log/rax-autoscaler/logging.log'
+LOG_MAX_BYTES = 10 * 1024 * 1024
+# Seconds, or None to only rotate by size
+LOG_ROTATE_INTERVAL = 24 * 60 * 60
+LOG_BACKUP_COUNT = 5
+LOG_COMPRESS = True
+
+RECENT_RUNS = 5
+RUN_MAX_LINES = 500
+
+# rax-autoscaler logs its decision on every run. Scaling down while not
+# all servers are in the load balancer counts as a failure
+DECISION = 'Consensus was to '
+SCALE_DOWN = 'Consensus was to scale down'
+
+
+def write_atomically(file_name, data):
+    """ Writes to a temporary file which then replaces file_name, so readers
+        never see a partially written file
+    """
+    tmp_file = '%s.%d.tmp' % (file_name, os.getpid())
+    with open(tmp_file, 'w') as fp:
+        fp.write(data)
+    os.rename(tmp_file, file_name)
+
+
+def remove(file_name):
+    try:
+        os.remove(file_name)
+    except OSError:
+        pass
+
+
+def get_max_failures():
+    if READINESS_FILE:
+        try:
+            with open(READINESS_FILE, 'r') as fp:
+                settings = json.load(fp).get('settings')
+            if settings:
+                return settings['max_failures']
+        except (IOError, ValueError, KeyError):
+            pass
+    return MAX_FAILURES
+
+
+def read_fail_count():
+    try:
+        with open(FAIL_COUNT, 'r') as fp:
+            return int(fp.read().strip() or 0)
+    except (IOError, ValueError):
+        return 0
+
+
+class Run(object):
+    """ Outcome of one run of rax-autoscaler, with the tail of its output """
+
+    def __init__(self):
+        self.started = time.time()
+        self.lines = deque(maxlen=RUN_MAX_LINES)
+        self.dropped = 0
+        self.decided = False
+        self.scale_down = False
+        self.returncode = None
+
+    def add_line(self, line):
+        if len(self.lines) == self.lines.maxlen:
+            self.dropped += 1
+        self.lines.append(line)
+        if DECISION in line:
+            self.decided = True
+            self.scale_down = self.scale_down or SCALE_DOWN in line
+
+    def format(self):
+        header = '=== %s, exit code %s ===\n' % (
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started)),
+            self.returncode)
+        if self.dropped:
+            header += '(%d earlier lines not kept)\n' % self.dropped
+        return header + ''.join(self.lines)
+
+
+class RotatingLogHandler(RotatingFileHandler):
+    """ RotatingFileHandler that also rotates when a new interval starts,
+        and can gzip the rotated files
+    """
+
+    def __init__(self, filename, max_bytes=0, interval=None, backup_count=0,
+                 compress=False):
+        RotatingFileHandler.__init__(self, filename, maxBytes=max_bytes,
+                                     backupCount=backup_count)
+        self.interval = interval
+        self.compress = compress
+        # Which interval the last line was logged in. Taken from the
+        # modification time of the log, as this usually only runs for a
+        # moment at a time
+        if os.path.exists(self.baseFilename):
+            self.period = self.get_period(
+                os.stat(self.baseFilename).st_mtime)
+        else:
+            self.period = self.get_period(time.time())
+
+    def get_period(self, timestamp):
+        if not self.interval:
+            return None
+        return int(timestamp // self.interval)
+
+    def shouldRollover(self, record):
+        if self.period != self.get_period(time.time()):
+            return 1
+        return RotatingFileHandler.shouldRollover(self, record)
+
+    def backup_name(self, i):
+        name = '%s.%d' % (self.baseFilename, i)
+        if self.compress:
+            name += '.gz'
+        return name
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        self.period = self.get_period(time.time())
+        if self.backupCount > 0:
+            for i in range(self.backupCount - 1, 0, -1):
+                if os.path.exists(self.backup_name(i)):
+                    os.rename(self.backup_name(i), self.backup_name(i + 1))
+            if not self.compress:
+                os.rename(self.baseFilename, self.backup_name(1))
+            elif os.path.exists(self.baseFilename):
+                tmp_file = '%s.%d.tmp' % (self.backup_name(1), os.getpid())
+                with open(self.baseFilename, 'rb') as src:
+                    with gzip.open(tmp_file, 'wb') as dst:
+                        shutil.copyfileobj(src, dst)
+                os.rename(tmp_file, self.backup_name(1))
+        self.mode = 'w'
+        self.stream = self._open()
+
+
+def get_log():
+    log = logging.getLogger('rax-autoscaler')
+    if not log.handlers:
+        log.propagate = False
+        handler = RotatingLogHandler(LOG_FILE, max_bytes=LOG_MAX_BYTES,
+                                     interval=LOG_ROTATE_INTERVAL,
+                                     backup_count=LOG_BACKUP_COUNT,
+                                     compress=LOG_COMPRESS)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        log.addHandler(handler)
+        log.setLevel(logging.INFO)
+    return log
+
+
+def run_autoscaler(log):
+    """ Runs rax-autoscaler, logging its output as it comes """
+    run = Run()
+    proc = subprocess.Popen(AUTOSCALE_COMMAND, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    for line in iter(proc.stdout.readline, ''):
+        log.info(line.rstrip('\n'))
+        run.add_line(line)
+    proc.stdout.close()
+    run.returncode = proc.wait()
+    return run
+
+
+def check(run, recent_runs, fails):
+    """ Updates the fail count and fail file after a run, returns the new
+        fail count
+    """
+    # Most likely the wording of the log line changed, which would otherwise
+    # go unnoticed as the counter is reset on every run
+    if not run.decided:
+        print("No scaling decision found in the output of rax-autoscaler,"
+              " check %s" % LOG_FILE, file=sys.stderr)
+
+    if run.scale_down:
+        fails += 1
+        write_atomically(FAIL_COUNT, '%d\n' % fails)
+        # Generate FAIL_FILE if failures > MAX_FAILURES limit
+        if fails > get_max_failures():
+            write_atomically(FAIL_FILE, '\n'.join(r.format()
+                                                  for r in recent_runs))
+    else:
+        fails = 0
+        remove(FAIL_COUNT)
+        remove(FAIL_FILE)
+    return fails
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        'Run rax-autoscaler and alert if it keeps being unable to scale down')
+    parser.add_argument('--interval', type=int, default=None,
+                        help='Keep running, and run rax-autoscaler every'
+                             ' this many seconds rather than just once')
+    args = parser.parse_args()
+
+    log = get_log()
+    recent_runs = deque(maxlen=RECENT_RUNS)
+    fails = read_fail_count()
+    while True:
+        run = run_autoscaler(log)
+        recent_runs.append(run)
+        fails = check(run, recent_runs, fails)
+        if not args.interval:
+            break
+        time.sleep(max(0, run.started + args.interval - time.time()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+""" This module manages several scaling groups from one process.
+    Every config file in a directory is parsed up front, one identity
+    context is authenticated per set of credentials, and the groups are
+    then diffed and updated through a bounded thread pool.
+    Invoked by --config-dir
+"""
+import os
+import glob
+import threading
+import pyrax
+import utils
+import autoscale
+from multiprocessing.pool import ThreadPool
+from colors import bcolors, print_msg
+
+
+class RegionClient(object):
+    """ Stands in for the pyrax module when handed to autoscale.autoscale,
+        exposing the clients of an authenticated context for one region
+    """
+
+    def __init__(self, context, region):
+        self.identity = context
+        self.region = region
+        self.exceptions = pyrax.exceptions
+        self.autoscale = context.get_client('autoscale', region)
+
+
+class GroupResult(object):
+    """ Outcome of reconciling a single config file """
+
+    def __init__(self, config_file):
+        self.config_file = config_file
+        self.config = None
+        self.client = None
+        self.group = None
+        self.messages = []
+        self.error = None
+        self.updated = False
+        self._lock = threading.Lock()
+
+    def msg(self, msg, col):
+        """ Buffers output, so it can be printed grouped per config file """
+        with self._lock:
+            self.messages.append((msg, col))
+
+    def get_changes(self):
+        if not self.group or not self.group.diffs:
+            return []
+        return sorted(k for k, v in self.group.diffs.iteritems() if v)
+
+
+def find_config_files(config_dir):
+    return sorted(glob.glob(os.path.join(os.path.expanduser(config_dir),
+                                         '*.ini')))
+
+
+def load_config(result):
+    """ Parses and validates a config file. Groups without an ID are left
+        out, as creating a group requires the interactive setup
+    """
+    try:
+        result.config = utils.config(result.config_file)
+        utils.config_fixup(result.config)
+    except (Exception, SystemExit) as ex:
+        result.error = "Unable to parse config: %s" % ex
+        return
+    if not result.config.as_config.id:
+        result.error = ("No scaling group ID set - run main.py with"
+                        " --config-file %s to create the group" %
+                        result.config_file)
+
+
+def authenticate(results):
+    """ Authenticates once per set of credentials and hands out one client
+        per region to each result
+    """
+    contexts = {}
+    clients = {}
+    for result in results:
+        if result.error:
+            continue
+        username, api_key, region = result.config.get_credentials()
+        try:
+            if (username, api_key) not in contexts:
+                context = pyrax.create_context('rackspace', username=username,
+                                               api_key=api_key)
+                context.authenticate()
+                contexts[(username, api_key)] = context
+            if (username, api_key, region) not in clients:
+                clients[(username, api_key, region)] = RegionClient(
+                    contexts[(username, api_key)], region)
+            result.client = clients[(username, api_key, region)]
+        except Exception as ex:
+            result.error = "Authentication failed: %s" % ex
+
+
+def diff_group(result, detailed_diff=False):
+    if result.error:
+        return result
+    try:
+        result.group = autoscale.autoscale(result.config, result.client,
+                                           sync=False, msg_func=result.msg,
+                                           detailed_diff=detailed_diff)
+    except Exception as ex:
+        result.error = "Unable to diff group: %s" % ex
+    return result
+
+
+def update_group(result):
+    try:
+        result.group.apply_diffs(result.group.diffs)
+        result.updated = True
+    except Exception as ex:
+        result.error = "Unable to update group: %s" % ex
+    return result
+
+
+def print_report(results):
+    for result in results:
+        name = result.config.as_config.name if result.config else None
+        print_msg("==> %s (%s)" % (result.config_file, name), bcolors.HEADER)
+        for msg, col in result.messages:
+            print_msg(msg, col)
+        if result.error:
+            print_msg(result.error, bcolors.FAIL)
+
+    in_sync = [r for r in results if not r.error and not r.get_changes()]
+    changed = [r for r in results if not r.error and r.get_changes()]
+    failed = [r for r in results if r.error]
+    print_msg("%d group(s) in sync, %d with changes, %d failed" % (
+              len(in_sync), len(changed), len(failed)), bcolors.OKBLUE)
+    for result in changed:
+        print_msg("  %s: %s%s" % (result.config_file,
+                                  ', '.join(result.get_changes()),
+                                  ' (updated)' if result.updated else ''),
+                  bcolors.WARNING)
+
+
+def reconcile(config_dir, max_workers=8, assume_yes=False,
+              detailed_diff=False):
+    """ Diffs every group configured in config_dir concurrently, prints a
+        combined report and optionally applies the changes found.
+        Returns the list of GroupResult objects
+    """
+    results = [GroupResult(f) for f in find_config_files(config_dir)]
+    if not results:
+        print_msg("No config files found in %s" % config_dir, bcolors.FAIL)
+        return results
+
+    for result in results:
+        load_config(result)
+    authenticate(results)
+
+    pool = ThreadPool(min(max_workers, len(results)))
+    try:
+        pool.map(lambda result: diff_group(result, detailed_diff), results)
+
+        print_report(results)
+        changed = [r for r in results if not r.error and r.get_changes()]
+        if changed and (assume_yes or utils.ask_str(
+                "Do you want to update the running config of %d group(s)"
+                " to match their config files? (y/n): " % len(changed),
+                yesno=True)):
+            for result in changed:
+                result.messages = []
+            pool.map(update_group, changed)
+            print_report(results)
+    finally:
+        pool.close()
+        pool.join()
+    return results
@@ -0,0 +1,135 @@
+""" Tests for load_balancing/ini_file.py
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import stat
+import shutil
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'load_balancing'))
+
+import ini_file
+
+CONFIG = """\
+# Settings for main.py
+[autoscale]
+; the group to manage
+name = web
+cooldown = 300
+    (continued)
+min_entities = 2
+
+[launch-configuration]
+# Image to build servers from
+image = abcd
+"""
+
+
+class ApplyChangesTest(unittest.TestCase):
+
+    def apply(self, changes, text=CONFIG):
+        return ''.join(ini_file.apply_changes(text.splitlines(True),
+                                              changes))
+
+    def test_comments_and_other_lines_are_kept(self):
+        result = self.apply({('autoscale', 'name'): 'api'})
+        self.assertEqual(result, CONFIG.replace('name = web', 'name = api'))
+
+    def test_existing_key_is_replaced(self):
+        result = self.apply({('autoscale', 'cooldown'): 561})
+        self.assertIn('cooldown = 561\nmin_entities = 2\n', result)
+        self.assertNotIn('300', result)
+        self.assertNotIn('(continued)', result)
+
+    def test_keys_match_case_insensitively(self):
+        result = self.apply({('autoscale', 'CoolDown'): 561})
+        self.assertEqual(result.count('cooldown'), 1)
+        self.assertIn('cooldown = 561\n', result)
+
+    def test_key_in_other_section_is_left_alone(self):
+        result = self.apply({('launch-configuration', 'name'): 'api'})
+        self.assertIn('name = web\n', result)
+        self.assertIn('image = abcd\nname = api\n', result)
+
+    def test_missing_key_is_added_to_its_section(self):
+        result = self.apply({('autoscale', 'max_entities'): 10})
+        self.assertIn('min_entities = 2\nmax_entities = 10\n\n'
+                      '[launch-configuration]', result)
+
+    def test_missing_section_is_added_at_the_end(self):
+        result = self.apply({('rax-autoscaler', 'reconcile_url'): 'x'})
+        self.assertTrue(result.startswith(CONFIG))
+        self.assertTrue(result.endswith(
+            'image = abcd\n\n[rax-autoscaler]\nreconcile_url = x\n'))
+
+
+class UpdateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.config_file = os.path.join(self.tmp_dir, 'config.ini')
+        with open(self.config_file, 'w') as fp:
+            fp.write(CONFIG)
+        os.chmod(self.config_file, 0600)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read(self):
+        with open(self.config_file, 'r') as fp:
+            return fp.read()
+
+    def test_file_is_updated(self):
+        ini_file.update(self.config_file, {('autoscale', 'cooldown'): 561,
+                                           ('autoscale', 'id'): 'abc'})
+        self.assertEqual(self.read(), CONFIG.replace(
+            'cooldown = 300\n    (continued)\nmin_entities = 2\n',
+            'cooldown = 561\nmin_entities = 2\nid = abc\n'))
+
+    def test_file_is_replaced_atomically(self):
+        inode = os.stat(self.config_file).st_ino
+        renames = []
+        rename = os.rename
+
+        def record_rename(src, dst):
+            # The new contents are complete before they replace the file
+            with open(src, 'r') as fp:
+                renames.append((os.path.dirname(src), dst, fp.read()))
+            rename(src, dst)
+        os.rename = record_rename
+        try:
+            ini_file.update(self.config_file, {('autoscale', 'name'): 'api'})
+        finally:
+            os.rename = rename
+
+        self.assertEqual(renames, [(self.tmp_dir, self.config_file,
+                                    self.read())])
+        self.assertNotEqual(os.stat(self.config_file).st_ino, inode)
+        self.assertEqual(stat.S_IMODE(os.stat(self.config_file).st_mode),
+                         0600)
+        # Only the lock file is left next to it
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                         ['config.ini', 'config.ini.lock'])
+
+    def test_file_is_left_alone_on_error(self):
+        rename = os.rename
+
+        def failing_rename(src, dst):
+            raise OSError("rename failed")
+        os.rename = failing_rename
+        try:
+            self.assertRaises(OSError, ini_file.update, self.config_file,
+                              {('autoscale', 'name'): 'api'})
+        finally:
+            os.rename = rename
+        self.assertEqual(self.read(), CONFIG)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                         ['config.ini', 'config.ini.lock'])
+
+
+if __name__ == '__main__':
+    unittest.main()
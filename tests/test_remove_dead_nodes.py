@@ -0,0 +1,157 @@
+""" Tests for the drain handling of load_balancing/remove_dead_nodes.py
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'load_balancing'))
+
+import remove_dead_nodes
+from remove_dead_nodes import DrainState, NodePlan
+
+LB_ID = 1234
+NOW = 1000000.0
+
+
+class Node(object):
+    """ Like pyrax's load balancer Node """
+
+    def __init__(self, id, address, status='ONLINE', condition='ENABLED'):
+        self.id = id
+        self.address = address
+        self.status = status
+        self.condition = condition
+
+
+class NodePlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.tmp_dir, 'drain.json')
+        self.drain_state = DrainState(self.state_file)
+        self.saved = (remove_dead_nodes.drain_timeout,
+                      remove_dead_nodes.delete_online)
+        remove_dead_nodes.drain_timeout = 30
+        remove_dead_nodes.delete_online = False
+
+    def tearDown(self):
+        (remove_dead_nodes.drain_timeout,
+         remove_dead_nodes.delete_online) = self.saved
+        shutil.rmtree(self.tmp_dir)
+
+    def plan(self, nodes, in_group=(), now=NOW):
+        return NodePlan(LB_ID, nodes, set(in_group), self.drain_state, now)
+
+    def test_group_members_are_left_alone(self):
+        plan = self.plan([Node(1, '10.0.0.1', status='OFFLINE')],
+                         in_group=['10.0.0.1'])
+        self.assertTrue(plan.is_empty())
+        self.assertEqual(plan.keep, [])
+
+    def test_stray_node_is_drained(self):
+        node = Node(1, '10.0.0.1', status='DEGRADED')
+        plan = self.plan([node])
+        self.assertEqual(plan.drain, [node])
+        self.assertEqual(plan.delete, [])
+
+    def test_online_node_is_kept(self):
+        node = Node(1, '10.0.0.1')
+        plan = self.plan([node])
+        self.assertEqual(plan.keep, [node])
+        self.assertTrue(plan.is_empty())
+
+    def test_offline_node_is_deleted_without_draining(self):
+        node = Node(1, '10.0.0.1', status='OFFLINE')
+        plan = self.plan([node])
+        self.assertEqual(plan.delete, [node])
+        self.assertEqual(plan.drain, [])
+
+    def test_drain_waits_until_expired(self):
+        node = Node(1, '10.0.0.1', status='DEGRADED', condition='DRAINING')
+        self.drain_state.start(LB_ID, node, NOW - 10)
+        plan = self.plan([node])
+        self.assertEqual(plan.delete, [])
+        self.assertEqual(plan.waiting, [(node, NOW + 20)])
+        self.assertEqual(plan.next_expiry(), NOW + 20)
+
+    def test_expired_drain_is_deleted(self):
+        node = Node(1, '10.0.0.1', status='DEGRADED', condition='DRAINING')
+        self.drain_state.start(LB_ID, node, NOW - 30)
+        plan = self.plan([node])
+        self.assertEqual(plan.delete, [node])
+        self.assertEqual(plan.waiting, [])
+
+    def test_unknown_drain_is_counted_from_now(self):
+        node = Node(1, '10.0.0.1', status='DEGRADED', condition='DRAINING')
+        plan = self.plan([node])
+        self.assertEqual(plan.waiting, [(node, NOW + 30)])
+
+    def test_no_connections_deletes_drain_early(self):
+        node = Node(1, '10.0.0.1', status='DEGRADED', condition='DRAINING')
+        self.drain_state.start(LB_ID, node, NOW - 1)
+        plan = self.plan([node])
+        plan.release_drained(0)
+        self.assertEqual(plan.delete, [node])
+        self.assertEqual(plan.waiting, [])
+        self.assertEqual(plan.next_expiry(), None)
+
+    def test_connections_keep_drain_waiting(self):
+        node = Node(1, '10.0.0.1', status='DEGRADED', condition='DRAINING')
+        self.drain_state.start(LB_ID, node, NOW - 1)
+        for current_connections in (3, None):
+            plan = self.plan([node])
+            plan.release_drained(current_connections)
+            self.assertEqual(plan.delete, [])
+            self.assertEqual(plan.waiting, [(node, NOW + 29)])
+
+
+class DrainStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.tmp_dir, 'drain.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_prune_drops_nodes_no_longer_draining(self):
+        draining = Node(1, '10.0.0.1', condition='DRAINING')
+        enabled = Node(2, '10.0.0.2')
+        gone = Node(3, '10.0.0.3', condition='DRAINING')
+        other_lb = Node(4, '10.0.0.4', condition='DRAINING')
+        state = DrainState(self.state_file)
+        for node in (draining, enabled, gone):
+            state.start(LB_ID, node, NOW)
+        state.start(LB_ID + 1, other_lb, NOW)
+
+        state.prune(LB_ID, [draining, enabled])
+        state.save()
+
+        with open(self.state_file, 'r') as fp:
+            saved = json.load(fp)
+        self.assertEqual(sorted(saved), ['%s/1' % LB_ID,
+                                         '%s/4' % (LB_ID + 1)])
+        self.assertEqual(DrainState(self.state_file).started, saved)
+        self.assertEqual(os.listdir(self.tmp_dir), ['drain.json'])
+
+    def test_prune_without_nodes_forgets_the_load_balancer(self):
+        state = DrainState(self.state_file)
+        state.start(LB_ID, Node(1, '10.0.0.1', condition='DRAINING'), NOW)
+        state.prune(LB_ID, [])
+        self.assertEqual(state.started, {})
+
+    def test_missing_or_corrupt_file_starts_empty(self):
+        self.assertEqual(DrainState(self.state_file).started, {})
+        with open(self.state_file, 'w') as fp:
+            fp.write('{not json')
+        self.assertEqual(DrainState(self.state_file).started, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+""" Tests for load_balancing/retry_policy.py
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'load_balancing'))
+
+from retry_policy import RetryPolicy, NotReady
+
+
+class ClientException(Exception):
+    """ Like pyrax.exceptions.ClientException """
+
+    def __init__(self, code, message):
+        self.code = code
+        self.message = message
+        super(ClientException, self).__init__(message)
+
+
+class Resource(object):
+    """ Goes through the given states, one per get() """
+
+    def __init__(self, *states):
+        self.states = list(states)
+        self.status = None
+        self.polls = 0
+
+    def get(self):
+        self.polls += 1
+        if self.states:
+            self.status = self.states.pop(0)
+
+
+class DelaysTest(unittest.TestCase):
+
+    def test_jitter_bounds(self):
+        policy = RetryPolicy(base=0.5, cap=10)
+        delays = policy.delays()
+        previous = policy.base
+        for _ in range(1000):
+            delay = next(delays)
+            self.assertTrue(policy.base <= delay <= policy.cap)
+            self.assertTrue(delay <= max(policy.base, previous * 3))
+            previous = delay
+
+    def test_delays_grow_to_cap(self):
+        policy = RetryPolicy(base=0.5, cap=10)
+        delays = policy.delays()
+        later = [next(delays) for _ in range(200)][100:]
+        self.assertTrue(max(later) > policy.base * 3)
+
+
+class ClassificationTest(unittest.TestCase):
+
+    def test_retry_codes(self):
+        policy = RetryPolicy()
+        for code in (413, 500, 503):
+            self.assertTrue(policy.is_retryable(ClientException(code, "")))
+        for code in (400, 401, 404, 422):
+            self.assertFalse(policy.is_retryable(
+                ClientException(code, "Bad request")))
+
+    def test_retry_messages(self):
+        policy = RetryPolicy()
+        self.assertTrue(policy.is_retryable(ClientException(
+            422, "Load Balancer '1' has a status of 'PENDING_UPDATE' and is"
+                 " considered immutable.")))
+        self.assertTrue(policy.is_retryable(Exception("LB is immutable")))
+        self.assertFalse(policy.is_retryable(ClientException(
+            422, "Duplicate nodes detected.")))
+
+    def test_not_ready_while_pending_is_retried(self):
+        policy = RetryPolicy()
+        self.assertTrue(policy.is_retryable(
+            NotReady("status is PENDING_UPDATE rather than ACTIVE")))
+        self.assertFalse(policy.is_retryable(
+            NotReady("status is ERROR rather than ACTIVE")))
+
+
+class CallTest(unittest.TestCase):
+
+    def test_retries_until_success(self):
+        policy = RetryPolicy(base=0.001, cap=0.01, deadline=5)
+        attempts = []
+
+        def func():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise ClientException(503, "Service unavailable")
+            return 'done'
+        self.assertEqual(policy.call(func), 'done')
+        self.assertEqual(len(attempts), 3)
+
+    def test_gives_up_at_deadline(self):
+        policy = RetryPolicy(base=0.01, cap=0.02, deadline=0.2)
+        attempts = []
+
+        def func():
+            attempts.append(1)
+            raise ClientException(422, "PENDING_UPDATE")
+        started = time.time()
+        self.assertRaises(ClientException, policy.call, func)
+        self.assertTrue(time.time() - started <= 0.2 + 0.05)
+        self.assertTrue(len(attempts) > 1)
+
+    def test_does_not_retry_other_errors(self):
+        policy = RetryPolicy(base=0.001, deadline=5)
+        attempts = []
+
+        def func():
+            attempts.append(1)
+            raise ClientException(400, "Invalid address")
+        self.assertRaises(ClientException, policy.call, func)
+        self.assertEqual(len(attempts), 1)
+
+
+class WaitUntilTest(unittest.TestCase):
+
+    def test_returns_once_reached(self):
+        policy = RetryPolicy(base=0.001, cap=0.01)
+        lb = Resource('PENDING_UPDATE', 'PENDING_UPDATE', 'ACTIVE')
+        self.assertTrue(policy.wait_until(lb, 'status', 'ACTIVE'))
+        self.assertEqual(lb.polls, 3)
+
+    def test_raises_at_timeout(self):
+        policy = RetryPolicy(base=0.01, cap=0.02)
+        lb = Resource('PENDING_UPDATE')
+        started = time.time()
+        self.assertRaises(NotReady, policy.wait_until, lb, 'status',
+                          'ACTIVE', timeout=0.1)
+        self.assertTrue(time.time() - started <= 0.1 + 0.05)
+
+    def test_call_retries_while_pending(self):
+        policy = RetryPolicy(base=0.01, cap=0.02, deadline=5)
+        lb = Resource(*(['PENDING_UPDATE'] * 10 + ['ACTIVE']))
+        changes = []
+
+        def change():
+            policy.wait_until(lb, 'status', 'ACTIVE', timeout=0.05)
+            changes.append(lb.status)
+        policy.call(change)
+        self.assertEqual(changes, ['ACTIVE'])
+
+
+if __name__ == '__main__':
+    unittest.main()
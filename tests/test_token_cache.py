@@ -0,0 +1,79 @@
+""" Authenticates the real pyrax package through token_cache.authenticate()
+    against benchmark/fake_api.py. Skipped when pyrax isn't installed.
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmark'))
+
+import fake_api
+from fake_api import FakeCloud, FakeApiServer
+from load_balancing import token_cache
+
+try:
+    import pyrax
+except ImportError:
+    pyrax = None
+
+TOKENS = 'POST /v2.0/tokens'
+
+
+@unittest.skipIf(pyrax is None, "pyrax is not installed")
+class AuthenticateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cloud = FakeCloud(nodes=2)
+        self.server = FakeApiServer(self.cloud).start()
+        self.cache_dir = tempfile.mkdtemp()
+        pyrax.set_setting('identity_type', 'rackspace')
+        pyrax.set_setting('auth_endpoint', self.server.url + '/v2.0/')
+        pyrax.set_setting('region', fake_api.REGION)
+        pyrax.identity = None
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def authenticate(self, **kwargs):
+        token_cache.authenticate(pyrax, region=fake_api.REGION,
+                                 cache_dir=self.cache_dir, **kwargs)
+
+    def test_authenticates_and_connects(self):
+        self.authenticate(username='benchmark', api_key='benchmark')
+        self.assertTrue(pyrax.identity.authenticated)
+        self.assertEqual(self.cloud.stats()['calls'].get(TOKENS), 1)
+        group = pyrax.autoscale.get(fake_api.GROUP_ID)
+        self.assertEqual(group.id, fake_api.GROUP_ID)
+
+    def test_uses_cached_token(self):
+        self.authenticate(username='benchmark', api_key='benchmark')
+        pyrax.identity = None
+        self.cloud.reset_stats()
+        self.authenticate(username='benchmark', api_key='benchmark')
+        self.assertTrue(pyrax.identity.authenticated)
+        self.assertEqual(self.cloud.stats()['calls'].get(TOKENS), None)
+        lb = pyrax.cloud_loadbalancers.get(fake_api.LB_ID)
+        self.assertEqual(lb.id, fake_api.LB_ID)
+
+    def test_credential_file(self):
+        credential_file = os.path.join(self.cache_dir, 'credentials')
+        with open(credential_file, 'w') as fp:
+            fp.write("[rackspace_cloud]\n"
+                     "username = benchmark\n"
+                     "api_key = benchmark\n")
+        self.authenticate(credential_file=credential_file)
+        self.assertTrue(pyrax.identity.authenticated)
+        self.assertEqual(pyrax.identity.username, 'benchmark')
+        self.assertTrue(pyrax.cloudservers.servers.list())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,38 @@
 """ Various utilities used throughout this project """
 import ConfigParser
 import ast
+import copy
 import base64
 import os
+import threading
 import novaclient
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 from jinja2 import Environment
 from launch_configuration import LaunchConfig
 from autoscale_configuration import AutoscaleConfig
 from colors import bcolors, print_msg
+from load_balancing import ini_file
+
+# Timeout in seconds (connect, read) for direct REST calls
+HTTP_TIMEOUT = (10, 30)
+
+# Number of entries get_object_from_list() shows at a time
+PAGE_SIZE = 20
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+# Sections read from each ini file, by path, along with the mtime, size and
+# inode of the file they were read from. See read_ini()
+_ini_cache = {}
+# Values parsed from the raw strings in the ini files. See parse_value()
+_value_cache = {}
+_cache_lock = threading.Lock()
+
+TYPE_NAMES = {basestring: 'string', int: 'int', bool: 'boolean',
+              list: 'list', dict: 'dictionary'}
 
 
 def config_fixup(parsed_config):
@@ -59,6 +84,25 @@ def config_fixup(parsed_config):
         else parsed_config.as_config.scale_down
 
 
+def get_http_session():
+    """ Returns the requests session shared by all direct REST calls, so
+        connections are kept alive and reused rather than set up for every
+        request. Idempotent requests that fail to connect or get a 5xx
+        response are retried.
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            retries = Retry(total=3, backoff_factor=0.5,
+                            status_forcelist=[500, 502, 503, 504])
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16,
+                                  max_retries=retries)
+            _http_session = requests.Session()
+            _http_session.mount('https://', adapter)
+            _http_session.mount('http://', adapter)
+        return _http_session
+
+
 def b64_strip(data):
     return base64.encodestring(data).replace('\n', '')
 
@@ -84,12 +128,84 @@ def get_parse_error(key, section, expected_type):
             " type %s" % (key, section, expected_type))
 
 
+def get_missing_error(key, section):
+    return ("Config file parsing failed - key %s is missing or has no value"
+            " in section '%s' Try re-running with --create-config" % (
+                key, section))
+
+
+def check_section(section_config):
+    """ Checks the attributes of one of the config classes against its
+        schema, which maps each key to its type and whether it is required.
+        Raises AttributeError for the first key that is missing or of the
+        wrong type
+    """
+    for key, (expected_type, required) in sorted(
+            section_config.schema.iteritems()):
+        value = getattr(section_config, key)
+        if value is None:
+            if required:
+                raise AttributeError(get_missing_error(
+                    key, section_config.section))
+        elif not isinstance(value, expected_type):
+            raise AttributeError(get_parse_error(
+                key, section_config.section, TYPE_NAMES[expected_type]))
+    return True
+
+
+def read_ini(file_name):
+    """ Returns the sections of an ini file as a list of (section, items)
+        tuples. The file is only read and parsed again once its mtime, size
+        or inode has changed
+    """
+    file_name = os.path.abspath(file_name)
+    st = os.stat(file_name)
+    version = (st.st_mtime, st.st_size, st.st_ino)
+    with _cache_lock:
+        cached = _ini_cache.get(file_name)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    cfg = ConfigParser.ConfigParser()
+    with open(file_name, 'r') as fp:
+        cfg.readfp(fp)
+    sections = [(section, cfg.items(section)) for section in cfg.sections()]
+    with _cache_lock:
+        _ini_cache[file_name] = (version, sections)
+    return sections
+
+
+def parse_value(raw):
+    """ Evaluates a value from the config file as a Python literal. Each
+        distinct value is only evaluated once, and a copy handed out
+    """
+    with _cache_lock:
+        if raw in _value_cache:
+            return copy.deepcopy(_value_cache[raw])
+    value = ast.literal_eval(raw)
+    with _cache_lock:
+        _value_cache[raw] = value
+    return copy.deepcopy(value)
+
+
 class AutoscalerConfig(object):
     """ Holds configuration attributes for the [rax-autoscaler] part
         of the config file. Mainly populated and used when a group
         is created or changed.
     """
 
+    section = 'rax-autoscaler'
+    # Type of each key, and whether it is required
+    schema = {'scale_up_webhook': (basestring, False),
+              'scale_down_webhook': (basestring, False),
+              'scale_up_policy': (basestring, False),
+              'scale_down_policy': (basestring, False),
+              'load_balancers': (list, True),
+              'private_key': (basestring, True),
+              'admin_server': (basestring, True),
+              'num_static_servers': (int, False),
+              'reconcile_url': (basestring, False)}
+
     def __init__(self):
         pass
     scale_up_webhook = None
@@ -101,26 +217,13 @@ class AutoscalerConfig(object):
     private_key = None
     admin_server = None
     num_static_servers = None
+    reconcile_url = None
 
     def validate(self):
-        """ Iterates over class attributes and verifies that they have been set
-        during the config parsing or config writing process
+        """ Verifies that the attributes have been set to values of the
+        right type during the config parsing or config writing process
         """
-        # In some cases, ConfigParse will think these are strings...
-        if not isinstance(self.load_balancers, list):
-            raise AttributeError("Config file validation failed - key"
-                                 " load_balancers is missing or has no value"
-                                 " in section 'rax-autoscaler' Try re-running"
-                                 " with --create-config")
-
-        expected_strs = ['private_key', 'admin_server']
-        for obj in [obj for obj in dir(self) if not obj.startswith('__')]:
-            if not isinstance(getattr(
-                    self, obj), str) and obj in expected_strs:
-                raise AttributeError("Config file validation failed - key"
-                                     " %s is missing or has no value"
-                                     " in section 'rax-autoscaler'"
-                                     " re-running with --create-config" % obj)
+        return check_section(self)
 
 
 def ask_integer(msg, allowed_input=None):
@@ -195,43 +298,86 @@ def add_new_key(pyrax):
     return name
 
 
+def filter_objects(objects, search):
+    """ Returns the objects whose name or ID contains search, ignoring case """
+    search = search.lower()
+    return [obj for obj in objects if search in unicode(obj.name).lower()
+            or search in unicode(obj.id).lower()]
+
+
 def get_object_from_list(obj, name, create_new_option=False,
-                         quit_option=False, extra_options=None):
-    """ Takes a pyrax object and calls list() on that, and presents
-        the output as a numbered list for user to choose from.
-        Returns the ID part of the chosen pyrax object unless
-        get_name is set to True.
+                         quit_option=False, extra_options=None,
+                         page_size=PAGE_SIZE):
+    """ Takes a pyrax object and calls list() on that, or a list of objects
+        with a name and id (e.g. from catalog.Catalog), and presents them
+        as a numbered list for user to choose from.
+        Lists longer than page_size are shown a page at a time, and typing
+        anything other than a number only lists the objects whose name or
+        ID contain it.
+        Returns the ID part of the chosen object.
     """
-    cnt = 0
-    index = {}
-    objects = []
-    try:
-        # Most objects have a list_all method, but fall back to .list() if not
-        objects = obj.list_all()
-    except AttributeError:
-        objects = obj.list()
-
-    for entry in objects:
-        cnt += 1
-        print "%d - %s (%s)" % (cnt, entry.name, entry.id)
-        index[cnt] = entry.id
+    if isinstance(obj, list):
+        objects = obj
+    else:
+        try:
+            # Most objects have a list_all method, but fall back to .list()
+            # if not
+            objects = obj.list_all()
+        except AttributeError:
+            objects = obj.list()
+
+    options = []
     if extra_options:
-        for k in extra_options:
-            cnt += 1
-            print "%d - %s" % (cnt, k)
-            index[cnt] = extra_options.get(k)
+        options.extend(extra_options.iteritems())
     if create_new_option:
-        cnt += 1
-        print "%d - Create new" % cnt
-        index[cnt] = None
+        options.append(("Create new", None))
     if quit_option:
-        cnt += 1
-        print "%d - Done" % cnt
-        index[cnt] = None
+        options.append(("Done", None))
 
-    prompt = "Select %s: " % name
-    ret = index.get(ask_integer(prompt, allowed_input=xrange(1, cnt + 1)))
-    return ret
+    search = ''
+    page = 0
+    while True:
+        matches = filter_objects(objects, search) if search else objects
+        pages = max(1, (len(matches) + page_size - 1) // page_size)
+        page = min(max(page, 0), pages - 1)
+        first = page * page_size
+        for cnt, entry in enumerate(matches[first:first + page_size],
+                                    first + 1):
+            print "%d - %s (%s)" % (cnt, entry.name, entry.id)
+        for cnt, (option, _) in enumerate(options, len(matches) + 1):
+            print "%d - %s" % (cnt, option)
+
+        hints = []
+        if pages > 1:
+            print_msg("Page %d of %d, %d %s" % (
+                page + 1, pages, len(matches),
+                "matching '%s'" % search if search else 'in total'),
+                bcolors.OKBLUE)
+            hints.append("> or < for the next or previous page")
+        if len(objects) > page_size or search:
+            hints.append("text to search for")
+        if search:
+            hints.append("nothing to clear the search")
+        prompt = "Select %s%s: " % (
+            name, " (or %s)" % ", ".join(hints) if hints else '')
+
+        ret = ask_str(prompt).strip()
+        if ret.isdigit():
+            choice = int(ret)
+            if 1 <= choice <= len(matches):
+                return matches[choice - 1].id
+            if len(matches) < choice <= len(matches) + len(options):
+                return options[choice - len(matches) - 1][1]
+            print_msg("Answer not in range", bcolors.FAIL)
+        elif ret == '>':
+            page += 1
+        elif ret == '<':
+            page -= 1
+        elif ret or search:
+            search = ret
+            page = 0
+        else:
+            print_msg("Value must be a number", bcolors.FAIL)
 
 
 class config(object):
@@ -243,7 +389,9 @@ class config(object):
     def __init__(self, config_file, validate=True, credentials_only=False):
         self.config_file = config_file
         self.cfg = ConfigParser.ConfigParser()
-        self.read_config()
+        # (section, key) -> value set by set_config_option(), not yet
+        # written out by flush()
+        self.changes = {}
         self.as_config = AutoscaleConfig()
         self.lc_config = LaunchConfig()
         self.ras_config = AutoscalerConfig()
@@ -276,13 +424,10 @@ class config(object):
         return (self.username, self.api_key, self.region)
 
     def set_config_option(self, section, key, value):
-        """ Sets an attribute of a config class and
-            writes they key and value out to the config file
-            under the appropriate section
+        """ Sets an attribute of a config class and the key and value
+            under the appropriate section. The change is written out to
+            the config file by the next flush()
         """
-        if not self.cfg.has_section(section):
-            self.cfg.add_section(section)
-
         if isinstance(value, str) or isinstance(value, unicode):
             value = "'%s'" % value
         if section == 'autoscale':
@@ -291,8 +436,28 @@ class config(object):
             setattr(self.lc_config, key, value)
         elif section == 'rax-autoscaler':
             setattr(self.ras_config, key, value)
-        self.cfg.set(section, key, value)
-        self.cfg.write(open(self.config_file, 'w'))
+        self.changes[(section, key)] = value
+        self.apply_changes(self.cfg)
+
+    def apply_changes(self, cfg):
+        # Stored as strings, as if they had been read from the file
+        for (section, key), value in self.changes.iteritems():
+            if not cfg.has_section(section):
+                cfg.add_section(section)
+            cfg.set(section, key, str(value))
+
+    def flush(self):
+        """ Writes all changes made by set_config_option() out to the
+            config file at once. Other runs are locked out while the file is
+            re-read and the changes applied to it, and the file is replaced
+            atomically, so it is never left half written
+        """
+        if not self.changes:
+            return
+        ini_file.update(self.config_file, dict(
+            (option, str(value)) for option, value in
+            self.changes.iteritems()))
+        self.changes = {}
 
     def get_keys(self, section):
         ret = []
@@ -305,12 +470,21 @@ class config(object):
         return ret
 
     def read_config(self, config_file=None):
-        """ Reads the config file into self.cfg instance """
+        """ Reads the config file into self.cfg instance. The file is only
+            parsed again if it has changed since it was last read
+        """
         config_file = config_file if config_file else self.config_file
         try:
-            self.cfg.readfp(open(config_file, 'r'))
-        except IOError as ex:
+            sections = read_ini(config_file)
+        except (IOError, OSError) as ex:
             raise Exception("Unable to open config file: %s" % ex)
+        for section, items in sections:
+            if not self.cfg.has_section(section):
+                self.cfg.add_section(section)
+            for key, val in items:
+                self.cfg.set(section, key, val)
+        # Changes not written out yet still apply
+        self.apply_changes(self.cfg)
 
     def parse_credentials(self, config_file=None):
         if self.username and self.api_key and self.region:
@@ -337,8 +511,8 @@ class config(object):
         # And check for a credentials_file key, and re-parse using that file
         # if found. If it isn't, bomb out, we have no credentials
         try:
-            self.credentials_file = ast.literal_eval(self.cfg.get(section,
-                                                     'credentials_file'))
+            self.credentials_file = parse_value(self.cfg.get(
+                section, 'credentials_file'))
             self.parse_credentials(self.credentials_file)
         except ConfigParser.NoSectionError:
             print_msg("Config file %s does not contain a 'cloud' or"
@@ -354,30 +528,29 @@ class config(object):
         self.cfg.remove_section(section)
 
     def parse_config(self):
-
+        """ Parses and type-checks every key in one pass over the config
+            file, setting them on the config class for their section
+        """
         self.read_config()
         conf = {}
+        sections = {'autoscale': self.as_config,
+                    'launch-configuration': self.lc_config,
+                    'rax-autoscaler': self.ras_config}
 
         for section in self.cfg.sections():
             if section not in conf:
                 conf[section] = {}
+            section_config = sections.get(section)
             for key, val in self.cfg.items(section):
                 try:
                     if section == 'cloud':
                         getattr(self, key)
-                        setattr(self, key, ast.literal_eval(val))
-
-                    elif section == 'autoscale':
-                        getattr(self.as_config, key)
-                        setattr(self.as_config, key, ast.literal_eval(val))
-
-                    elif section == 'launch-configuration':
-                        getattr(self.lc_config, key)
-                        setattr(self.lc_config, key, ast.literal_eval(val))
+                        setattr(self, key, parse_value(val))
 
-                    elif section == 'rax-autoscaler':
-                        getattr(self.ras_config, key)
-                        setattr(self.ras_config, key, ast.literal_eval(val))
+                    elif section_config is not None:
+                        if key not in section_config.schema:
+                            raise AttributeError(key)
+                        setattr(section_config, key, parse_value(val))
 
                     conf[section][key] = val
                 except AttributeError: